@@ -0,0 +1,67 @@
+"""Compare `utils.merge` with the previous generator based implementation.
+
+    python -m benchmarks.bench_merge
+"""
+import random
+import timeit
+
+from k8s_app_abstraction.utils import merge
+
+
+def legacy_merge(dict1, dict2):
+    for k in set(dict1.keys()).union(dict2.keys()):
+        if k in dict1 and k in dict2:
+            if isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
+                yield (k, dict(legacy_merge(dict1[k], dict2[k])))
+            else:
+                yield (k, dict2[k])
+        elif k in dict1:
+            yield (k, dict1[k])
+        else:
+            yield (k, dict2[k])
+
+
+def include_tree(files: int, resources: int, seed: int = 0) -> list:
+    """Documents as produced by a tree of `files` includes sharing resources"""
+    rnd = random.Random(seed)
+    documents = []
+    for i in range(files):
+        documents.append(
+            {
+                "deployments": {
+                    f"app-{rnd.randrange(resources)}": {
+                        "image": f"image-{i}",
+                        "replicas": rnd.randrange(1, 5),
+                        "labels": {"team": f"team-{i % 7}", "tier": "backend"},
+                    }
+                    for _ in range(resources // 4)
+                },
+                "statefulsets": {
+                    f"db-{rnd.randrange(resources)}": {"image": "postgres"}
+                    for _ in range(resources // 8)
+                },
+            }
+        )
+    return documents
+
+
+def run(files: int = 50, resources: int = 400, number: int = 20):
+    documents = include_tree(files, resources)
+
+    def legacy():
+        result = {}
+        for document in documents:
+            result = dict(legacy_merge(result, document))
+        return result
+
+    def current():
+        return merge(*documents)
+
+    assert legacy() == current()
+    for name, func in (("legacy", legacy), ("merge", current)):
+        elapsed = min(timeit.repeat(func, number=number, repeat=5)) / number
+        print(f"{name:>8}: {elapsed * 1000:.3f} ms per merge of {files} documents")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,161 @@
+"""Benchmark the parse, generate, render and dump hot paths.
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --save-baseline benchmarks/baseline.json
+    python -m benchmarks.suite --baseline benchmarks/baseline.json
+
+When a baseline is given, the command exits with a non-zero status if any
+benchmark got slower than `--threshold` times its baseline time.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+from tempfile import TemporaryDirectory
+
+import yaml
+
+from k8s_app_abstraction.models.stack import Stack
+from k8s_app_abstraction.utils import dict_to_yaml, parse_yaml
+
+KINDS = ("deployments", "daemonsets", "statefulsets")
+
+
+def stack_definition(size: int) -> dict:
+    """Definition with `size` resources spread over every pod controller kind"""
+    definition = {kind: {} for kind in KINDS}
+    for i in range(size):
+        resource = {"image": f"registry.local/app-{i}:1.0.{i}"}
+        if i % 2:
+            resource["command"] = ["python", "-m", f"app_{i}"]
+        if KINDS[i % 3] != "daemonsets":
+            resource["replicas"] = i % 5 + 1
+        definition[KINDS[i % 3]][f"app-{i}"] = resource
+    return definition
+
+
+def include_tree(folder: str, depth: int, fanout: int = 3) -> str:
+    """Write an include tree of `depth` levels and return its root definition"""
+
+    def _write(level: int, index: str) -> str:
+        filename = os.path.join(folder, f"level-{level}-{index}.yml")
+        content = {
+            "deployments": {
+                f"app-{level}-{index}": {"image": "registry.local/app", "replicas": 1}
+            }
+        }
+        if level < depth:
+            content["include"] = [
+                _write(level + 1, f"{index}{i}") for i in range(fanout)
+            ]
+        with open(filename, "w") as f:
+            yaml.safe_dump(content, f)
+        return filename
+
+    return yaml.safe_dump({"include": [_write(1, str(i)) for i in range(fanout)]})
+
+
+def timed(func, number: int = 1, repeat: int = 3) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def run(sizes, depths, number: int = None) -> dict:
+    results = {}
+    for size in sizes:
+        definition = stack_definition(size)
+        content = yaml.safe_dump(definition)
+        stack = Stack.new(name="bench", definition=content)
+        manifests = list(stack.generate())
+        context = {"stack": stack}
+        iterations = number or max(1, 1000 // size)
+
+        results[f"parse_yaml[{size}]"] = timed(lambda: parse_yaml(content), iterations)
+        results[f"stack_validation[{size}]"] = timed(
+            lambda: Stack(name="bench", **definition), iterations
+        )
+        results[f"stack_construct_trusted[{size}]"] = timed(
+            lambda: Stack.construct_trusted(name="bench", **definition), iterations
+        )
+        results[f"stack_generate[{size}]"] = timed(
+            lambda: list(stack.generate()), iterations
+        )
+        results[f"dict_to_yaml[{size}]"] = timed(
+            lambda: [dict_to_yaml(m, context, camelize_keys=False) for m in manifests],
+            iterations,
+        )
+        results[f"stack_to_yaml[{size}]"] = timed(
+            lambda: "---\n".join(
+                content for _, content in stack.yaml_files(context, memoize=False)
+            ),
+            iterations,
+        )
+        results[f"stack_to_yaml_cached[{size}]"] = timed(stack.to_yaml, iterations)
+        with TemporaryDirectory() as folder:
+            results[f"chart_dump[{size}]"] = timed(
+                lambda: stack.chart.dump(folder, force=True), iterations
+            )
+
+    for depth in depths:
+        with TemporaryDirectory() as folder:
+            root = include_tree(folder, depth)
+            results[f"parse_yaml_includes[depth={depth}]"] = timed(
+                lambda: parse_yaml(root)
+            )
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, elapsed in results.items():
+        reference = baseline.get(name)
+        ratio = elapsed / reference if reference else None
+        flag = ""
+        if ratio is not None and ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        ratio_text = f"{ratio:6.2f}x" if ratio is not None else "    new"
+        print(f"{name:40} {elapsed * 1000:10.3f} ms {ratio_text}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--save-baseline", help="write the results as baseline")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument(
+        "--number", type=int, help="iterations per timing, scaled by size if unset"
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.depths, number=args.number)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    for filename in filter(None, (args.output, args.save_baseline)):
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the baseline")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
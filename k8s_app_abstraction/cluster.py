@@ -0,0 +1,137 @@
+"""Connection to the kubernetes cluster shared by every resource and chart.
+
+The session loads the kube config once, owns the pooled `ApiClient` used by
+all the kubernetes API objects and caches the server version::
+
+    set_session(ClusterSession(context="staging", pool_size=32))
+    for stack in stacks:
+        stack.chart.rollout()  # no config reload nor version round trip
+
+A default session reading the kube config (or the in-cluster configuration)
+is created on first use of `get_session()`.
+"""
+
+from distutils.version import StrictVersion
+from threading import Lock, RLock
+from time import monotonic
+from typing import Optional
+
+import kubernetes
+from kubernetes import client, config
+from kubernetes.config.config_exception import ConfigException
+
+# Connections kept open to the API server, shared by every thread
+DEFAULT_POOL_SIZE = 16
+# Seconds the server version is cached for
+VERSION_TTL = 300
+
+
+class ClusterSession(object):
+    def __init__(
+        self,
+        configuration: Optional[client.Configuration] = None,
+        config_file: Optional[str] = None,
+        context: Optional[str] = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        version_ttl: float = VERSION_TTL,
+    ):
+        self.config_file = config_file
+        self.context = context
+        self.pool_size = pool_size
+        self.version_ttl = version_ttl
+        self._configuration = configuration
+        self._api_client = None
+        self._apis = {}
+        self._version = None
+        self._version_expires = 0
+        self._lock = RLock()
+        self._version_lock = Lock()
+
+    @property
+    def configuration(self) -> client.Configuration:
+        with self._lock:
+            if self._configuration is None:
+                configuration = client.Configuration()
+                try:
+                    config.load_kube_config(
+                        config_file=self.config_file,
+                        context=self.context,
+                        client_configuration=configuration,
+                    )
+                except ConfigException:
+                    if self.config_file or self.context:
+                        raise
+                    config.load_incluster_config(client_configuration=configuration)
+                self._configuration = configuration
+            return self._configuration
+
+    @property
+    def api_client(self) -> client.ApiClient:
+        with self._lock:
+            if self._api_client is None:
+                configuration = self.configuration
+                configuration.connection_pool_maxsize = self.pool_size
+                self._api_client = client.ApiClient(configuration)
+            return self._api_client
+
+    def api(self, api_class):
+        """Instance of the kubernetes `api_class` bound to the session client"""
+        with self._lock:
+            if api_class not in self._apis:
+                self._apis[api_class] = api_class(self.api_client)
+            return self._apis[api_class]
+
+    def version(self, refresh: bool = False) -> client.VersionInfo:
+        """Server version, fetched again once `version_ttl` expired"""
+        # Fetched under its own lock so that concurrent callers wait for a
+        # single request, while the session lock stays free for API calls
+        with self._version_lock:
+            with self._lock:
+                if not refresh and self._version is not None:
+                    if monotonic() < self._version_expires:
+                        return self._version
+                api = self.api(client.VersionApi)
+
+            fetched_at = monotonic()
+            version = api.get_code()
+            with self._lock:
+                self._version = version
+                self._version_expires = fetched_at + self.version_ttl
+            return version
+
+    def check_compatibility(self):
+        server = self.version()
+        library_version = StrictVersion(kubernetes.__version__)
+        assert abs(int(server.minor) - library_version.version[0]) <= 1, (
+            f"kubernetes library {library_version} is not "
+            f"compatible with server version {server.git_version}"
+        )
+
+    def close(self):
+        """Close the pooled connections, the next call opens new ones"""
+        with self._lock:
+            if self._api_client is not None:
+                self._api_client.close()
+            self._api_client = None
+            self._apis = {}
+
+
+_session = None
+_session_lock = Lock()
+
+
+def get_session() -> ClusterSession:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = ClusterSession()
+        return _session
+
+
+def set_session(session: Optional[ClusterSession]) -> Optional[ClusterSession]:
+    """Use `session` for every kubernetes call, or reset to the default one.
+    Returns the previous session."""
+    global _session
+    with _session_lock:
+        previous, _session = _session, session
+    return previous
@@ -0,0 +1,104 @@
+"""Timing and memory instrumentation of the render and rollout phases.
+
+Listeners are callables receiving ``(event, span)`` where event is either
+``"start"`` or ``"end"``::
+
+    def listener(event, span):
+        if event == "end":
+            print(span.phase, span.kind, span.name, span.duration)
+
+    add_listener(listener)
+
+Spans are only recorded while at least one listener is registered, otherwise
+`span()` returns a shared no-op context manager.
+"""
+
+import tracemalloc
+from contextlib import nullcontext
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Optional
+
+_listeners = ()
+_trace_memory = False
+_started_tracing = False
+_lock = Lock()
+_disabled = nullcontext()
+
+
+class Span(object):
+    __slots__ = ("phase", "kind", "name", "start", "end", "memory_delta", "_memory")
+
+    def __init__(self, phase: str, kind: Optional[str], name: Optional[str]):
+        self.phase = phase
+        self.kind = kind
+        self.name = name
+        self.start = None
+        self.end = None
+        self.memory_delta = None
+        self._memory = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def __enter__(self):
+        if _trace_memory:
+            _start_tracing()
+            self._memory = tracemalloc.get_traced_memory()[0]
+
+        self.start = perf_counter()
+        _notify("start", self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end = perf_counter()
+        if self._memory is not None and tracemalloc.is_tracing():
+            self.memory_delta = tracemalloc.get_traced_memory()[0] - self._memory
+
+        _notify("end", self)
+
+    def __repr__(self):
+        return f"Span({self.phase!r}, kind={self.kind!r}, name={self.name!r})"
+
+
+def _notify(event: str, span: Span):
+    for listener, _ in _listeners:
+        listener(event, span)
+
+
+def _start_tracing():
+    global _started_tracing
+    with _lock:
+        if _trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+
+
+def span(phase: str, kind: Optional[str] = None, name: Optional[str] = None):
+    """Context manager measuring `phase`, optionally for a given resource"""
+    if not _listeners:
+        return _disabled
+
+    return Span(phase, kind, name)
+
+
+def add_listener(listener: Callable, trace_memory: bool = False):
+    """Register `listener`, `trace_memory` adds tracemalloc deltas to spans"""
+    global _listeners, _trace_memory
+    with _lock:
+        _listeners = _listeners + ((listener, trace_memory),)
+        _trace_memory = any(memory for _, memory in _listeners)
+
+
+def remove_listener(listener: Callable):
+    global _listeners, _trace_memory, _started_tracing
+    with _lock:
+        _listeners = tuple((l, m) for l, m in _listeners if l is not listener)
+        _trace_memory = any(memory for _, memory in _listeners)
+        if not _trace_memory and _started_tracing:
+            # Only stop tracemalloc when it was started for our listeners
+            tracemalloc.stop()
+            _started_tracing = False
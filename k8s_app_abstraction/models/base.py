@@ -1,11 +1,60 @@
-from typing import Generator, Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from math import ceil
+from threading import Lock
+from typing import Generator, NamedTuple, Optional, TextIO
 
 from pydantic import BaseModel
 
+from k8s_app_abstraction.instrumentation import span
 from k8s_app_abstraction.utils import dict_to_yaml
 
+# Default values safe to share between the instances of `construct_trusted`
+IMMUTABLE_DEFAULTS = (type(None), bool, int, float, str, bytes, tuple, frozenset)
+_trusted_fields = {}
+
 
 class Base(BaseModel):
+    @classmethod
+    def construct_trusted(cls, **values):
+        """Like `construct()` for values known to be valid, made to build many
+        instances: unknown keys are ignored and immutable defaults shared"""
+        fields = _trusted_fields.get(cls)
+        if fields is None:
+            fields = _trusted_fields[cls] = [
+                (
+                    name,
+                    field,
+                    not field.required
+                    and field.default_factory is None
+                    and isinstance(field.default, IMMUTABLE_DEFAULTS),
+                )
+                for name, field in cls.__fields__.items()
+            ]
+
+        data = {}
+        for name, field, shared in fields:
+            if name in values:
+                data[name] = values[name]
+            elif shared:
+                data[name] = field.default
+            elif not field.required:
+                data[name] = field.get_default()
+
+        instance = cls.__new__(cls)
+        object.__setattr__(instance, "__dict__", data)
+        object.__setattr__(instance, "__fields_set__", set(values) & set(data))
+        instance._init_private_attributes()
+        return instance
+
+    def __setattr__(self, name, value):
+        super(Base, self).__setattr__(name, value)
+        if name in self.__fields__:
+            self._invalidate()
+
+    def _invalidate(self):
+        """Called when a field is assigned, to drop what was derived from it"""
+
     def generate(self) -> Generator:
         raise NotImplementedError()
 
@@ -14,15 +63,100 @@ class YamlMixin:
     def generate(self) -> Generator:
         raise NotImplementedError()
 
+    @staticmethod
+    def yaml_filename(manifest: dict) -> str:
+        return "{}.yml".format(
+            "-".join([manifest["kind"].lower(), manifest["metadata"]["name"]])
+        )
+
     def yaml_files(self, context: dict = None) -> Generator:
 
         for el in self.generate():
-            filename = "{}.yml".format(
-                "-".join([el["kind"].lower(), el["metadata"]["name"]])
-            )
-            yield filename, dict_to_yaml(el, context=context)
+            with span("render", kind=el["kind"], name=el["metadata"]["name"]):
+                content = dict_to_yaml(el, context=context, camelize_keys=False)
+            yield self.yaml_filename(el), content
+
+    def write_yaml(self, stream: TextIO, context: dict = None):
+        """Write every generated manifest to `stream`, one at a time"""
+        for i, el in enumerate(self.generate()):
+            if i:
+                stream.write("---\n")
+            with span("render", kind=el["kind"], name=el["metadata"]["name"]):
+                dict_to_yaml(el, context=context, camelize_keys=False, stream=stream)
+
+    def to_yaml(self, context: dict = None, stream: TextIO = None) -> Optional[str]:
+        if stream is not None:
+            return self.write_yaml(stream, context=context)
 
-    def to_yaml(self, context: dict = None) -> str:
         return "---\n".join(
             content for file, content in self.yaml_files(context=context)
         )
+
+
+class _StackRef(NamedTuple):
+    """The part of a stack rendering reads, see `Context.fingerprint`"""
+
+    name: str
+
+
+def _portable_context(context: Optional[dict]) -> Optional[dict]:
+    """`context` with its stack replaced by what rendering reads of it, cheap
+    to send along every chunk of resources"""
+    if not context or context.get("stack") is None:
+        return context
+    return dict(context, stack=_StackRef(context["stack"].name))
+
+
+def _render_chunk(resources: list, context: Optional[dict]) -> list:
+    files = []
+    for resource in resources:
+        el = resource.generate()
+        files.append(
+            (
+                YamlMixin.yaml_filename(el),
+                dict_to_yaml(el, context=context, camelize_keys=False),
+            )
+        )
+    return files
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def render_pool(processes: int) -> ProcessPoolExecutor:
+    """Pool of `processes` workers shared by every parallel render, started
+    on first use"""
+    with _pools_lock:
+        pool = _pools.get(processes)
+        if pool is None:
+            pool = _pools[processes] = ProcessPoolExecutor(max_workers=processes)
+        return pool
+
+
+def shutdown_render_pools():
+    """Stop the workers of the shared render pools"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+def render_parallel(
+    resources: list, context: dict, processes: int, chunksize: int = None
+) -> Generator:
+    """Render the yaml files of `resources` on the shared pool of `processes`.
+
+    Resources are sent to the workers in chunks to amortize pickling, along
+    with the stack name rather than the whole stack. Files are yielded in the
+    same order as `resources`.
+    """
+    if not chunksize:
+        chunksize = max(1, ceil(len(resources) / (processes * 4)))
+
+    chunks = [resources[i : i + chunksize] for i in range(0, len(resources), chunksize)]
+    context = _portable_context(context)
+    pool = render_pool(processes)
+    for files in pool.map(_render_chunk, chunks, repeat(context, len(chunks))):
+        yield from files
@@ -53,6 +53,32 @@ class BasePodController(NamespacedResource):
     def _pod_controller_extras(self):
         return {}
 
+    @property
+    def _spec_manifest(self):
+        labels = self._metadata_defaults["labels"]
+        return {
+            "selector": {
+                "matchLabels": {
+                    k: v
+                    for k, v in labels.items()
+                    if k.startswith("app.kubernetes.io/")
+                }
+            },
+            "template": {
+                "metadata": {"labels": dict(labels)},
+                "spec": {"containers": self._containers_manifest},
+            },
+        }
+
+    @property
+    def _containers_manifest(self):
+        container = {"name": self.name, "image": self.image}
+        if self.command is not None:
+            container["args"] = self.command
+        if self.entrypoint is not None:
+            container["command"] = self.entrypoint
+        return [container]
+
     @property
     def _api_resource_class(self):
         raise NotImplementedError()
@@ -61,25 +87,53 @@ class BasePodController(NamespacedResource):
     def _api_spec_class(self):
         raise NotImplementedError()
 
-    def generate(self):
+    def to_client_model(self):
         return self._api_resource_class(
             **self._resource_defaults,
             spec=self._api_spec_class(
                 **self._pod_controller_defaults, **self._pod_controller_extras
             ),
-        ).to_dict()
+        )
+
+    @classmethod
+    def rollout_complete(cls, obj) -> bool:
+        """Whether the live `obj` of this kind finished rolling out"""
+        raise NotImplementedError()
+
+    @classmethod
+    def rollout_failure(cls, obj) -> Optional[str]:
+        """Why the rollout of the live `obj` failed, if it did"""
+        for condition in (obj.status and obj.status.conditions) or []:
+            if condition.reason == "ProgressDeadlineExceeded":
+                return condition.message or condition.reason
+        return None
+
+    @staticmethod
+    def _observed(obj) -> bool:
+        return obj.status is not None and (obj.status.observed_generation or 0) >= (
+            obj.metadata.generation or 0
+        )
+
+    def generate(self):
+        # camelCase manifest built straight from the model fields, equivalent
+        # to `to_client_model().to_dict()` once its keys are camelized.
+        return dict(self._resource_manifest, spec=self._spec_manifest)
 
 
 class ReplicaSetController(BasePodController):
     replicas: int = 1
 
     @property
-    def _pod_controller_defaults(self):
+    def _spec_manifest(self):
         return dict(
-            merge(
-                super(ReplicaSetController, self)._pod_controller_defaults,
-                {"replicas": self.replicas},
-            )
+            super(ReplicaSetController, self)._spec_manifest, replicas=self.replicas
+        )
+
+    @property
+    def _pod_controller_defaults(self):
+        return merge(
+            super(ReplicaSetController, self)._pod_controller_defaults,
+            {"replicas": self.replicas},
         )
 
 
@@ -88,6 +142,23 @@ class Deployment(ReplicaSetController):
     _api_resource_class = client.V1Deployment
     _api_spec_class = client.V1DeploymentSpec
     _api_loader = "read_namespaced_deployment"
+    _api_list_loader = "list_namespaced_deployment"
+    _api_patcher = "patch_namespaced_deployment"
+    _api_deleter = "delete_namespaced_deployment"
+
+    @classmethod
+    def rollout_complete(cls, obj) -> bool:
+        if not cls._observed(obj):
+            return False
+
+        status = obj.status
+        replicas = obj.spec.replicas if obj.spec.replicas is not None else 1
+        updated = status.updated_replicas or 0
+        return (
+            updated >= replicas
+            and (status.available_replicas or 0) >= replicas
+            and (status.replicas or 0) <= updated
+        )
 
 
 class Daemonset(BasePodController):
@@ -95,6 +166,20 @@ class Daemonset(BasePodController):
     _api_resource_class = client.V1DaemonSet
     _api_spec_class = client.V1DaemonSetSpec
     _api_loader = "read_namespaced_daemon_set"
+    _api_list_loader = "list_namespaced_daemon_set"
+    _api_patcher = "patch_namespaced_daemon_set"
+    _api_deleter = "delete_namespaced_daemon_set"
+
+    @classmethod
+    def rollout_complete(cls, obj) -> bool:
+        if not cls._observed(obj):
+            return False
+
+        status = obj.status
+        desired = status.desired_number_scheduled or 0
+        return (status.updated_number_scheduled or 0) >= desired and (
+            status.number_available or 0
+        ) >= desired
 
 
 class Statefulset(ReplicaSetController):
@@ -102,11 +187,30 @@ class Statefulset(ReplicaSetController):
     _api_resource_class = client.V1StatefulSet
     _api_spec_class = client.V1StatefulSetSpec
     _api_loader = "read_namespaced_stateful_set"
+    _api_list_loader = "list_namespaced_stateful_set"
+    _api_patcher = "patch_namespaced_stateful_set"
+    _api_deleter = "delete_namespaced_stateful_set"
+
+    @classmethod
+    def rollout_complete(cls, obj) -> bool:
+        if not cls._observed(obj):
+            return False
+
+        status = obj.status
+        replicas = obj.spec.replicas if obj.spec.replicas is not None else 1
+        return (status.ready_replicas or 0) >= replicas and (
+            status.update_revision is None
+            or status.current_revision == status.update_revision
+        )
 
     @property
     def _pod_controller_extras(self):
         return {"service_name": self.name}
 
+    @property
+    def _spec_manifest(self):
+        return dict(super(Statefulset, self)._spec_manifest, serviceName=self.name)
+
 
 class DeploymentList(ResourceList):
     pass
@@ -1,15 +1,72 @@
-from typing import Optional
+import asyncio
+from functools import partial
+from hashlib import sha256
+from typing import Optional, Tuple
 
 from kubernetes.client import V1ObjectMeta
+from pydantic import PrivateAttr
 
+from k8s_app_abstraction.cluster import get_session
+from k8s_app_abstraction.instrumentation import span
 from k8s_app_abstraction.models.base import Base, YamlMixin
-from k8s_app_abstraction.utils import Prefixed, merge
+from k8s_app_abstraction.utils import Context, Prefixed, dict_to_yaml, merge
+
+FIELD_MANAGER = "k8s-app-abstraction"
+APPLY_CONTENT_TYPE = "application/apply-patch+yaml"
 
 
 class Resource(Base, YamlMixin):
     name: str
     _kind = None
-    _apis = {}
+    # Last rendered yaml file, as `(render_key, (filename, content))`
+    _rendered: Optional[tuple] = PrivateAttr(None)
+
+    def _invalidate(self):
+        self._rendered = None
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the kind and current field values of the resource"""
+        content = "{}.{}:{}".format(
+            type(self).__module__, type(self).__qualname__, self.json()
+        )
+        return sha256(content.encode("utf-8")).hexdigest()
+
+    def render_key(self, context: dict = None) -> tuple:
+        return self.fingerprint, Context(context).fingerprint
+
+    def rendered(self, context: dict = None) -> Optional[Tuple[str, str]]:
+        """The yaml file last rendered with `context`, if the fields did not
+        change since, in place or not"""
+        return self._lookup_rendered(self.render_key(context))
+
+    def keep_rendered(self, context: dict, file: Tuple[str, str]):
+        """Memoize `file` as the yaml file of the resource for `context`"""
+        self._rendered = (self.render_key(context), file)
+
+    def _lookup_rendered(self, key: tuple) -> Optional[Tuple[str, str]]:
+        rendered = self._rendered
+        if rendered is not None and rendered[0] == key:
+            return rendered[1]
+        return None
+
+    def render(self, context: dict = None, memoize: bool = True) -> Tuple[str, str]:
+        """The `(filename, content)` yaml file of the resource, memoized on the
+        instance for its current fields and the last render context unless
+        `memoize` is off"""
+        key = self.render_key(context)
+        file = self._lookup_rendered(key)
+        if file is not None:
+            return file
+
+        with span("generate", kind=self._kind, name=self.name):
+            el = self.generate()
+        with span("render", kind=el["kind"], name=el["metadata"]["name"]):
+            content = dict_to_yaml(el, context=context, camelize_keys=False)
+        file = self.yaml_filename(el), content
+        if memoize:
+            self._rendered = (key, file)
+        return file
 
     @property
     def _resource_defaults(self):
@@ -31,17 +88,25 @@ class Resource(Base, YamlMixin):
             },
         }
 
+    @property
+    def _resource_manifest(self):
+        return {
+            "apiVersion": self.api_version,
+            "kind": self._kind,
+            "metadata": self._metadata_defaults,
+        }
+
     @property
     def metadata(self):
         return V1ObjectMeta(**self._metadata_defaults)
 
+    @classmethod
+    def kubernetes_api(cls):
+        return get_session().api(cls._api)
+
     @property
     def kubernetes_loader(self):
-        api_name = self._api.__name__
-        if api_name not in self._apis:
-            self._apis[api_name] = self._api()
-        api = self._apis[api_name]
-        return getattr(api, self._api_loader)
+        return getattr(self.kubernetes_api(), self._api_loader)
 
     def kubernetes_resource(self, stack: "Stack" = None):
         name = Prefixed(self.name).render(context={"stack": stack})
@@ -50,11 +115,40 @@ class Resource(Base, YamlMixin):
     def get_from_kubernetes(self, stack: "Stack" = None):
         return self.kubernetes_resource(stack=stack)
 
+    def apply_to_kubernetes(self, manifest: dict):
+        """Server-side apply of the rendered `manifest` of this resource"""
+        return getattr(self.kubernetes_api(), self._api_patcher)(
+            name=manifest["metadata"]["name"],
+            body=manifest,
+            field_manager=FIELD_MANAGER,
+            force=True,
+            _content_type=APPLY_CONTENT_TYPE,
+        )
+
+    async def aget_from_kubernetes(
+        self, stack: "Stack" = None, semaphore: asyncio.Semaphore = None
+    ):
+        """`get_from_kubernetes` run on the event loop executor, at most as
+        many concurrent requests as `semaphore` allows"""
+        loop = asyncio.get_running_loop()
+        fetch = partial(self.get_from_kubernetes, stack=stack)
+        if semaphore is None:
+            return await loop.run_in_executor(None, fetch)
+
+        async with semaphore:
+            return await loop.run_in_executor(None, fetch)
+
 
 class ResourceList(list):
     def generate(self):
         for el in self:
-            yield el.generate()
+            with span("generate", kind=el._kind, name=el.name):
+                manifest = el.generate()
+            yield manifest
+
+
+# Number of resource names per label selector of a batched list call
+LIST_BATCH_SIZE = 50
 
 
 class NamespacedResource(Resource):
@@ -62,13 +156,54 @@ class NamespacedResource(Resource):
 
     @property
     def _metadata_defaults(self):
-        return dict(
-            merge(
-                super(NamespacedResource, self)._metadata_defaults,
-                {"namespace": self.namespace},
-            )
+        return merge(
+            super(NamespacedResource, self)._metadata_defaults,
+            {"namespace": self.namespace},
         )
 
     def kubernetes_resource(self, stack: "Stack" = None):
         name = Prefixed(self.name).render(context={"stack": stack})
         return self.kubernetes_loader(namespace=self.namespace, name=name)
+
+    def apply_to_kubernetes(self, manifest: dict):
+        return getattr(self.kubernetes_api(), self._api_patcher)(
+            name=manifest["metadata"]["name"],
+            namespace=self.namespace,
+            body=manifest,
+            field_manager=FIELD_MANAGER,
+            force=True,
+            _content_type=APPLY_CONTENT_TYPE,
+        )
+
+    @classmethod
+    def list_labelled_from_kubernetes(cls, namespace: str, label_selector: str):
+        """Objects of this kind in `namespace` matching `label_selector`"""
+        lister = getattr(cls.kubernetes_api(), cls._api_list_loader)
+        return lister(namespace=namespace, label_selector=label_selector).items
+
+    @classmethod
+    def delete_from_kubernetes(cls, namespace: str, name: str):
+        deleter = getattr(cls.kubernetes_api(), cls._api_deleter)
+        return deleter(name=name, namespace=namespace)
+
+    @classmethod
+    def list_from_kubernetes(
+        cls, namespace: str, resources: list, stack: "Stack" = None
+    ) -> dict:
+        """Fetch `resources` of this kind living in `namespace` with list calls
+        filtered by their instance label, keyed by their kubernetes name"""
+        lister = getattr(cls.kubernetes_api(), cls._api_list_loader)
+        wanted = {
+            Prefixed(res.name).render(context={"stack": stack}) for res in resources
+        }
+        names = sorted({res.name for res in resources})
+        found = {}
+        for i in range(0, len(names), LIST_BATCH_SIZE):
+            selector = "app.kubernetes.io/instance in ({})".format(
+                ",".join(names[i : i + LIST_BATCH_SIZE])
+            )
+            for item in lister(namespace=namespace, label_selector=selector).items:
+                if item.metadata.name in wanted:
+                    found[item.metadata.name] = item
+
+        return found
@@ -1,16 +1,43 @@
+import asyncio
+import json
 import os
+import tarfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from distutils.version import LooseVersion, StrictVersion
 from enum import Enum
-from subprocess import STDOUT, CalledProcessError, check_output
-from tempfile import TemporaryDirectory
-from typing import Optional
+from gzip import GzipFile
+from hashlib import sha256
+from io import BytesIO
+from subprocess import CalledProcessError
+from tempfile import NamedTemporaryFile
+from threading import Condition, Event, Thread
+from time import monotonic, perf_counter
+from typing import (
+    Any,
+    AsyncGenerator,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    TextIO,
+    Union,
+)
 
-import kubernetes
 import yaml
-from kubernetes import client, config
-from pydantic import validator
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from pydantic import PrivateAttr, validator
 
-from k8s_app_abstraction.models.base import Base, YamlMixin
+from k8s_app_abstraction import process
+from k8s_app_abstraction.cluster import get_session
+from k8s_app_abstraction.instrumentation import span
+from k8s_app_abstraction.models.base import (
+    Base,
+    YamlMixin,
+    render_parallel,
+)
 from k8s_app_abstraction.models.pod_controllers import (
     CronjobList,
     Daemonset,
@@ -20,8 +47,21 @@ from k8s_app_abstraction.models.pod_controllers import (
     Statefulset,
     StatefulsetList,
 )
-from k8s_app_abstraction.models.resource import Resource, ResourceList
-from k8s_app_abstraction.utils import dict_to_yaml, load_yaml_files, parse_yaml
+from k8s_app_abstraction.models.resource import (
+    FIELD_MANAGER,
+    Resource,
+    ResourceList,
+)
+from k8s_app_abstraction.process import command_output, prefixed_logger, run_command
+from k8s_app_abstraction.utils import (
+    Prefixed,
+    YamlLoader,
+    dict_to_yaml,
+    diff_dicts,
+    format_manifest,
+    load_yaml_files,
+    parse_yaml,
+)
 
 
 class Stack(Base, YamlMixin):
@@ -38,20 +78,93 @@ class Stack(Base, YamlMixin):
     cronjobs: Optional[CronjobList] = []
 
     @classmethod
-    def new(cls, name: str, definition: str) -> "Stack":
-        return Stack(name=name, **parse_yaml(definition))
+    def new(cls, name: str, definition: str, trusted: bool = False) -> "Stack":
+        """Stack of the yaml `definition`, see `construct_trusted` for
+        definitions known to be valid"""
+        definition = parse_yaml(definition)
+        if trusted:
+            return cls.construct_trusted(name, **definition)
+
+        with span("validate", kind="Stack", name=name):
+            return Stack(name=name, **definition)
+
+    @classmethod
+    def construct_trusted(cls, name: str, **definition) -> "Stack":
+        """Stack built without validation, for definitions known to be valid
+        such as the ones generated by our own tooling. The resources are
+        created with `construct_trusted()`: defaults are filled in, values
+        are neither checked nor coerced and unknown keys are ignored."""
+        with span("construct", kind="Stack", name=name):
+            values = {k: v for k, v in definition.items() if k in cls.__fields__}
+            for field, (list_class, resource_class) in TRUSTED_RESOURCES.items():
+                value = values.get(field)
+                if isinstance(value, dict):
+                    values[field] = list_class(
+                        resource_class.construct_trusted(name=res_name, **structure)
+                        for res_name, structure in value.items()
+                    )
+                elif isinstance(value, list):
+                    values[field] = list_class(value)
+            return cls.construct(name=name, **values)
 
     @classmethod
     def from_files(cls, *args: str) -> "Stack":
         definition = load_yaml_files(*args)
 
+    _chart: Optional["HelmChart"] = PrivateAttr(None)
+
+    def _invalidate(self):
+        self._chart = None
+
     @property
     def chart(self):
-        return HelmChart(stack=self, template_generator=self.yaml_files)
+        if self._chart is None:
+            self._chart = HelmChart(stack=self, template_generator=self.yaml_files)
+        return self._chart
 
-    def to_yaml(self, context: Optional[dict] = None) -> str:
+    def yaml_files(
+        self,
+        context: Optional[dict] = None,
+        processes: Optional[int] = None,
+        chunksize: Optional[int] = None,
+        memoize: bool = True,
+    ) -> Generator:
+        """Yaml files of the resources, reusing the ones they last rendered
+        with the same fields and context. Without `memoize` new files are not
+        kept on the resources, so that memory stays flat."""
+        resources = list(self.get_all_resources)
+        if not processes:
+            return (res.render(context, memoize=memoize) for res in resources)
+
+        return self._yaml_files_parallel(
+            resources, context, processes, chunksize, memoize
+        )
+
+    def _yaml_files_parallel(
+        self,
+        resources: list,
+        context: Optional[dict],
+        processes: int,
+        chunksize,
+        memoize: bool,
+    ) -> Generator:
+        files = [res.rendered(context) for res in resources]
+        missing = [i for i, file in enumerate(files) if file is None]
+        if missing:
+            rendered = render_parallel(
+                [resources[i] for i in missing], context, processes, chunksize
+            )
+            for i, file in zip(missing, rendered):
+                if memoize:
+                    resources[i].keep_rendered(context, file)
+                files[i] = file
+        return iter(files)
+
+    def to_yaml(
+        self, context: Optional[dict] = None, stream: Optional[TextIO] = None
+    ) -> Optional[str]:
         return super(Stack, self).to_yaml(
-            context={"stack": self} if context is None else context
+            context={"stack": self} if context is None else context, stream=stream
         )
 
     @property
@@ -72,7 +185,9 @@ class Stack(Base, YamlMixin):
                     for res in x.generate():
                         yield res
                 else:
-                    yield x.generate()
+                    with span("generate", kind=x._kind, name=x.name):
+                        manifest = x.generate()
+                    yield manifest
 
     @validator("deployments", pre=True)
     def cast_deployments(cls, value):
@@ -120,6 +235,56 @@ class Stack(Base, YamlMixin):
         raise ValueError("Invalid value for StatefulsetList")
 
 
+# Resource list fields of a stack built by `Stack.construct_trusted`
+TRUSTED_RESOURCES = {
+    "deployments": (DeploymentList, Deployment),
+    "daemonsets": (DaemonsetList, Daemonset),
+    "statefulsets": (StatefulsetList, Statefulset),
+}
+
+CHECKSUMS_FILE = ".checksums.json"
+# Hexadecimal digits of the content hash in the packaged archive names
+ARCHIVE_DIGEST_SIZE = 16
+
+
+class ChartChanges(Base):
+    created: List[str] = []
+    updated: List[str] = []
+    unchanged: List[str] = []
+    removed: List[str] = []
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.created or self.updated or self.removed)
+
+
+class ReleaseDiff(Base):
+    added: List[str] = []
+    removed: List[str] = []
+    changed: Dict[str, List[str]] = {}
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+class ApplyResult(Base):
+    applied: List[str] = []
+    pruned: List[str] = []
+
+
+# Concurrent kubernetes requests of the async read path and the apply engine
+DEFAULT_CONCURRENCY = 10
+
+# Kinds the apply engine looks into when pruning resources removed from a stack
+POD_CONTROLLERS = (Deployment, Daemonset, Statefulset)
+INSTANCE_LABEL = "app.kubernetes.io/instance"
+PART_OF_LABEL = "app.kubernetes.io/part-of"
+MANAGED_BY_LABEL = "app.kubernetes.io/managed-by"
+# Error of helm for releases never installed
+RELEASE_NOT_FOUND = "release: not found"
+
+
 class HelmChart(Base, YamlMixin):
     class TypeEnum(str, Enum):
         application = "application"
@@ -132,13 +297,23 @@ class HelmChart(Base, YamlMixin):
     def generate(self):
         return self.stack.generate()
 
-    def generate_files(self):
+    def yaml_files(self, context: Optional[dict] = None) -> Generator:
+        return self.stack.yaml_files(context=context)
+
+    def generate_files(
+        self,
+        processes: Optional[int] = None,
+        chunksize: Optional[int] = None,
+        memoize: bool = True,
+    ):
         yield self.generate_info_file()
-        for filename, template in self.yaml_files(
-            context={
-                "stack": self.stack,
-            }
-        ):
+        files = self.stack.yaml_files(
+            context={"stack": self.stack},
+            processes=processes,
+            chunksize=chunksize,
+            memoize=memoize,
+        )
+        for filename, template in files:
             yield f"templates/{filename}", template
 
     def generate_info_file(self):
@@ -152,9 +327,34 @@ class HelmChart(Base, YamlMixin):
             context=None,
         )
 
-    def dump(self, folder):
-        for filename, content in self.generate_files():
+    def dump(
+        self, folder, force: bool = False, processes: Optional[int] = None
+    ) -> "ChartChanges":
+        """Write the chart files into `folder`, skipping unchanged files and
+        removing the files of previous dumps no longer generated"""
+        with span("dump", kind="HelmChart", name=self.stack.name):
+            return self._dump(folder, force=force, processes=processes)
+
+    def _dump(self, folder, force: bool, processes: Optional[int]) -> "ChartChanges":
+        checksums_file = os.path.join(folder, CHECKSUMS_FILE)
+        previous = {}
+        if os.path.exists(checksums_file):
+            with open(checksums_file) as f:
+                previous = json.load(f)
+
+        checksums = {}
+        changes = ChartChanges()
+        # Streamed one file at a time, not memoized on the resources
+        files = self.generate_files(processes=processes, memoize=False)
+        for filename, content in files:
+            checksum = sha256(content.encode("utf-8")).hexdigest()
+            checksums[filename] = checksum
             absolute_filename = os.path.join(folder, filename)
+            exists = os.path.exists(absolute_filename)
+            if exists and not force and previous.get(filename) == checksum:
+                changes.unchanged.append(filename)
+                continue
+
             if "/" in filename:
                 file_folder = absolute_filename.rsplit("/", 1)[0]
                 os.makedirs(file_folder, exist_ok=True)
@@ -162,30 +362,234 @@ class HelmChart(Base, YamlMixin):
             with open(absolute_filename, "w") as f:
                 f.write(content)
 
+            (changes.updated if exists else changes.created).append(filename)
+
+        # Only files written by a previous dump, never hand-written ones
+        for filename in sorted(set(previous) - set(checksums)):
+            absolute_filename = os.path.join(folder, filename)
+            if os.path.exists(absolute_filename):
+                os.remove(absolute_filename)
+                changes.removed.append(filename)
+
+        with open(checksums_file, "w") as f:
+            json.dump(checksums, f, indent=2, sort_keys=True)
+
+        return changes
+
+    def archive(self, processes: Optional[int] = None) -> bytes:
+        """The chart packaged in memory as a `.tgz`, the same bytes for the
+        same files so that it can be cached by content"""
+        with span("package", kind="HelmChart", name=self.stack.name):
+            buffer = BytesIO()
+            with GzipFile(fileobj=buffer, mode="wb", mtime=0) as compressed:
+                with tarfile.open(fileobj=compressed, mode="w") as tar:
+                    for filename, content in self.generate_files(processes=processes):
+                        data = content.encode("utf-8")
+                        info = tarfile.TarInfo(f"{self.stack.name}/{filename}")
+                        info.size = len(data)
+                        info.mode = 0o644
+                        tar.addfile(info, BytesIO(data))
+            return buffer.getvalue()
+
+    def package(self, folder, processes: Optional[int] = None) -> str:
+        """Write the chart archive into `folder`, named after its content hash,
+        unless it is already there. Returns the archive path."""
+        data = self.archive(processes=processes)
+        digest = sha256(data).hexdigest()[:ARCHIVE_DIGEST_SIZE]
+        path = os.path.join(folder, f"{self.stack.name}-{digest}.tgz")
+        if not os.path.exists(path):
+            os.makedirs(folder, exist_ok=True)
+            # Written aside first so that readers never see a partial archive
+            partial = f"{path}.{os.getpid()}.tmp"
+            with open(partial, "wb") as f:
+                f.write(data)
+            os.replace(partial, path)
+        return path
+
     def check_compatibility(self):
-        server = client.VersionApi().get_code()
-        library_version = StrictVersion(kubernetes.__version__)
-        assert abs(int(server.minor) - library_version.version[0]) <= 1, (
-            f"kubernetes library {library_version} is not "
-            f"compatible with server version {server.git_version}"
-        )
+        get_session().check_compatibility()
+
+    def rollout(
+        self,
+        location: Optional[str] = None,
+        engine: str = "helm",
+        skip_unchanged: bool = False,
+        timeout: Optional[float] = None,
+        package: bool = False,
+    ):
+        """Install or upgrade the stack with `helm`, or with `apply` to use the
+        kubernetes API directly. The helm commands are killed after `timeout`
+        seconds.
 
-    def rollout(self, location: Optional[str] = None) -> "HelmRelease":
-        # Load kubernetes config
-        config.load_kube_config()
+        Without `location`, helm gets the chart as a single temporary archive.
+        With it, the chart files are dumped there, or with `package` the
+        archive is kept there named after its content hash.
 
+        With `skip_unchanged` the deployed release is compared with the
+        generated manifests first, the upgrade only happens when they differ
+        and the `ReleaseDiff` is returned. It needs the `helm` engine, the
+        `apply` one leaves no release to compare with.
+        """
+        _check_engine(engine, skip_unchanged)
+        with span("rollout", kind="HelmChart", name=self.stack.name):
+            return self._rollout(location, engine, skip_unchanged, timeout, package)
+
+    def _rollout(
+        self,
+        location: Optional[str],
+        engine: str,
+        skip_unchanged: bool,
+        timeout: Optional[float] = None,
+        package: bool = False,
+    ):
         self.check_compatibility()
 
-        def _rollout(loc: str) -> HelmRelease:
-            self.dump(loc)
-            self.exec(self.rollout_command(loc))
-            # return HelmRelease.load(self.stack.name)
+        if skip_unchanged:
+            diff = self.diff(timeout=timeout)
+            if diff.has_changes:
+                self._upgrade(location, engine, timeout, package)
+            return diff
+
+        return self._upgrade(location, engine, timeout, package)
+
+    def _upgrade(
+        self,
+        location: Optional[str],
+        engine: str,
+        timeout: Optional[float] = None,
+        package: bool = False,
+    ):
+        if engine == "apply":
+            return self.apply()
+
+        if location and package:
+            archive = self.package(location)
+            return self.exec(self.rollout_command(archive), timeout=timeout)
 
         if location:
-            return _rollout(location)
+            self.dump(location)
+            return self.exec(self.rollout_command(location), timeout=timeout)
 
-        with TemporaryDirectory() as location:
-            return _rollout(location)
+        return self.install_archive(self.archive(), timeout=timeout)
+
+    def install_archive(
+        self,
+        data: bytes,
+        logger: Optional[Callable[[str], None]] = None,
+        timeout: Optional[float] = None,
+    ):
+        """Install or upgrade the release with helm from the chart archive
+        `data` built by `archive()`"""
+        # Closed before running helm, Windows can't open it twice otherwise
+        with NamedTemporaryFile(
+            prefix=f"{self.stack.name}-", suffix=".tgz", delete=False
+        ) as f:
+            f.write(data)
+        try:
+            return self.exec(self.rollout_command(f.name), logger, timeout)
+        finally:
+            os.unlink(f.name)
+
+    def diff(
+        self,
+        release: Optional["HelmRelease"] = None,
+        timeout: Optional[float] = None,
+    ) -> ReleaseDiff:
+        """Structural difference between the deployed release, loaded with helm
+        unless given, and the manifests generated for the stack"""
+        if release is None:
+            try:
+                release = HelmRelease.load(self.stack.name, timeout=timeout)
+            except CalledProcessError as e:
+                if RELEASE_NOT_FOUND not in (e.output or ""):
+                    raise
+                release = HelmRelease(resource_definitions={})
+
+        deployed = release.resource_definitions
+        generated = {}
+        for filename, content in self.yaml_files(context={"stack": self.stack}):
+            manifest = yaml.safe_load(content)
+            generated[f"{manifest['kind']}/{manifest['metadata']['name']}"] = manifest
+
+        diff = ReleaseDiff(
+            added=[key for key in generated if key not in deployed],
+            removed=[key for key in deployed if key not in generated],
+        )
+        for key, manifest in generated.items():
+            if key in deployed:
+                changes = diff_dicts(deployed[key], manifest)
+                if changes:
+                    diff.changed[key] = changes
+
+        return diff
+
+    @property
+    def ownership_labels(self) -> dict:
+        return {PART_OF_LABEL: self.stack.name, MANAGED_BY_LABEL: FIELD_MANAGER}
+
+    def apply(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        prune: bool = True,
+        namespaces: Iterable[str] = (),
+    ) -> ApplyResult:
+        """Server-side apply every resource of the stack without helm, then
+        delete the resources of previous applies no longer in the stack.
+
+        Pruning only looks into the namespaces of the stack resources and
+        the extra `namespaces`, such as the ones a stack moved away from.
+        """
+        context = {"stack": self.stack}
+        labels = self.ownership_labels
+
+        def _apply(res: Resource) -> str:
+            manifest = format_manifest(
+                res.generate(), context=context, camelize_keys=False
+            )
+            metadata = manifest["metadata"]
+            metadata["labels"] = dict(metadata.get("labels") or {}, **labels)
+            with span("apply", kind=res._kind, name=res.name):
+                res.apply_to_kubernetes(manifest)
+            return f"{res._kind}/{res.namespace}/{metadata['name']}"
+
+        def _delete(stale: tuple) -> str:
+            kind, namespace, name = stale
+            with span("prune", kind=kind._kind, name=name):
+                kind.delete_from_kubernetes(namespace, name)
+            return f"{kind._kind}/{namespace}/{name}"
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            result = ApplyResult(
+                applied=list(pool.map(_apply, self.stack.get_all_resources))
+            )
+            if not prune:
+                return result
+
+            applied = set(result.applied)
+            selector = ",".join(f"{k}={v}" for k, v in labels.items())
+            scopes = [
+                (kind, namespace)
+                for kind in POD_CONTROLLERS
+                for namespace in sorted(
+                    {res.namespace for res in self.stack.get_all_resources}
+                    | set(namespaces)
+                )
+            ]
+            listed = pool.map(
+                lambda scope: scope[0].list_labelled_from_kubernetes(
+                    scope[1], label_selector=selector
+                ),
+                scopes,
+            )
+            stale = [
+                (kind, namespace, item.metadata.name)
+                for (kind, namespace), items in zip(scopes, listed)
+                for item in items
+                if f"{kind._kind}/{namespace}/{item.metadata.name}" not in applied
+            ]
+            result.pruned = list(pool.map(_delete, stale))
+
+        return result
 
     def rollout_command(self, location):
         return ["helm", "upgrade", "--install", self.stack.name, location]
@@ -193,41 +597,450 @@ class HelmChart(Base, YamlMixin):
     def uninstall(self):
         return self.exec(["helm", "delete", self.stack.name])
 
-    def exec(self, command: str):
-        def _log(output):
-            for line in output.decode("utf-8").splitlines():
-                print(line)
+    def exec(
+        self,
+        command: List[str],
+        logger: Optional[Callable[[str], None]] = None,
+        timeout: Optional[float] = None,
+    ):
+        """Run `command`, forwarding its output to `logger` as it comes"""
+        with span("helm", name=" ".join(command[:2])):
+            run_command(command, logger=logger, timeout=timeout)
 
+    @property
+    def release(self) -> "HelmRelease":
+        """Release made of the manifests currently generated for the stack"""
+        return HelmRelease(
+            resource_definitions={
+                f"{m['kind']}/{m['metadata']['name']}": m
+                for m in (
+                    yaml.safe_load(content)
+                    for _, content in self.yaml_files(context={"stack": self.stack})
+                )
+            }
+        )
+
+    def wait_until_ready(self, timeout: float = 300, watch_timeout: int = 5):
+        with span("wait_until_ready", kind="HelmChart", name=self.stack.name):
+            return self.release.wait_until_ready(
+                timeout=timeout, watch_timeout=watch_timeout
+            )
+
+    def get_kubernetes_resources(self, batched: bool = False):
+        if not batched:
+            for res in self.stack.get_all_resources:
+                yield res.get_from_kubernetes(stack=self.stack)
+            return
+
+        # One list call per kind and namespace instead of one read per resource
+        resources = list(self.stack.get_all_resources)
+        groups = {}
+        for res in resources:
+            groups.setdefault((type(res), res.namespace), []).append(res)
+
+        found = {}
+        for (kind, namespace), members in groups.items():
+            found[kind, namespace] = kind.list_from_kubernetes(
+                namespace, members, stack=self.stack
+            )
+
+        for res in resources:
+            name = Prefixed(res.name).render(context={"stack": self.stack})
+            item = found[type(res), res.namespace].get(name)
+            if item is None:
+                raise ApiException(status=404, reason=f"{res._kind} {name} not found")
+            yield item
+
+    async def aget_kubernetes_resources(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        semaphore: Optional[asyncio.Semaphore] = None,
+    ) -> AsyncGenerator:
+        """Async `get_kubernetes_resources`, resources are fetched concurrently
+        and yielded in the same order"""
+        semaphore = semaphore or asyncio.Semaphore(concurrency)
+        tasks = [
+            asyncio.ensure_future(
+                res.aget_from_kubernetes(stack=self.stack, semaphore=semaphore)
+            )
+            for res in self.stack.get_all_resources
+        ]
         try:
-            _log(check_output(command, stderr=STDOUT))
-        except CalledProcessError as e:
-            _log(e.output)
-            raise e
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def gather_kubernetes_resources(
+    *charts: HelmChart, concurrency: int = DEFAULT_CONCURRENCY
+) -> List[list]:
+    """Fetch the live resources of many charts at once, sharing the kubernetes
+    client and a single bound on the number of concurrent requests"""
+    semaphore = asyncio.Semaphore(concurrency)
 
-    def get_kubernetes_resources(self):
-        for res in self.stack.get_all_resources:
-            yield res.get_from_kubernetes(stack=self.stack)
+    async def _collect(chart: HelmChart) -> list:
+        return [
+            res async for res in chart.aget_kubernetes_resources(semaphore=semaphore)
+        ]
+
+    return list(await asyncio.gather(*(_collect(chart) for chart in charts)))
+
+
+class StackRollout(Base):
+    class StatusEnum(str, Enum):
+        succeeded = "succeeded"
+        failed = "failed"
+        skipped = "skipped"
+
+    name: str
+    status: Optional[StatusEnum] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    render_time: float = 0.0
+    rollout_time: float = 0.0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == self.StatusEnum.succeeded
+
+
+def _check_engine(engine: str, skip_unchanged: bool):
+    if skip_unchanged and engine != "helm":
+        raise ValueError("skip_unchanged compares with the helm release")
+
+
+def _rollout_order(dependencies: Dict[str, List[str]]) -> List[str]:
+    """Stack names sorted so that every stack comes after its dependencies"""
+    for name, deps in dependencies.items():
+        unknown = [dep for dep in deps if dep not in dependencies]
+        if unknown:
+            raise ValueError(f"Unknown dependencies of {name}: {', '.join(unknown)}")
+
+    order, remaining = [], dict(dependencies)
+    while remaining:
+        ready = [n for n, deps in remaining.items() if not set(deps) - set(order)]
+        if not ready:
+            raise ValueError(
+                "Dependency cycle between stacks: {}".format(", ".join(remaining))
+            )
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+    return order
+
+
+def rollout_stacks(
+    stacks: Iterable[Union[Stack, HelmChart]],
+    dependencies: Optional[Dict[str, Iterable[str]]] = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    engine: str = "helm",
+    skip_unchanged: bool = False,
+    timeout: Optional[float] = None,
+    processes: Optional[int] = None,
+) -> List[StackRollout]:
+    """Roll out many stacks with at most `concurrency` of them at once.
+
+    `dependencies` maps stack names to the names of the stacks that must be
+    rolled out successfully before them, the stacks depending on a failed
+    one are skipped. Charts are packaged ahead of their turn while the
+    others roll out. Returns a `StackRollout` per stack, in the given order.
+
+    Packaging threads only overlap rendering with the helm commands, the
+    templates of every chart are rendered on one shared pool of `processes`
+    worker processes when given, see `render_pool()`.
+    """
+    _check_engine(engine, skip_unchanged)
+    charts = {}
+    for item in stacks:
+        chart = item.chart if isinstance(item, Stack) else item
+        if chart.stack.name in charts:
+            raise ValueError(f"Stack {chart.stack.name} given twice")
+        charts[chart.stack.name] = chart
+
+    dependencies = dependencies or {}
+    pending = {name: list(dependencies.get(name, ())) for name in charts}
+    _rollout_order(pending)
+    results = {name: StackRollout(name=name) for name in charts}
+
+    get_session().check_compatibility()
+
+    def _render(name: str) -> Optional[bytes]:
+        if engine != "helm":
+            return None
+        started = perf_counter()
+        data = charts[name].archive(processes=processes)
+        results[name].render_time = perf_counter() - started
+        return data
+
+    def _upgrade(chart: HelmChart, data: Optional[bytes]):
+        if engine == "apply":
+            return chart.apply()
+        name = chart.stack.name
+        return chart.install_archive(data, prefixed_logger(name), timeout)
+
+    def _rollout(name: str, rendered: Future):
+        chart, result = charts[name], results[name]
+        started = perf_counter()
+        try:
+            data = rendered.result()
+            started = perf_counter()
+            with span("rollout", kind="HelmChart", name=name):
+                if skip_unchanged:
+                    # Same as HelmChart.rollout, the diff is the result
+                    result.result = chart.diff(timeout=timeout)
+                    if result.result.has_changes:
+                        _upgrade(chart, data)
+                else:
+                    result.result = _upgrade(chart, data)
+            result.status = StackRollout.StatusEnum.succeeded
+        except Exception as e:
+            result.status = StackRollout.StatusEnum.failed
+            result.error = "\n".join(filter(None, (str(e), getattr(e, "output", None))))
+        finally:
+            result.rollout_time = perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as render_pool:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            rendered = {name: render_pool.submit(_render, name) for name in charts}
+            running = {}
+            while pending or running:
+                scheduled = True
+                while scheduled:
+                    scheduled = False
+                    for name, deps in list(pending.items()):
+                        if any(results[dep].status is None for dep in deps):
+                            continue
+                        del pending[name]
+                        scheduled = True
+                        failed = [d for d in deps if not results[d].succeeded]
+                        if failed:
+                            rendered[name].cancel()
+                            results[name].status = StackRollout.StatusEnum.skipped
+                            results[
+                                name
+                            ].error = "Dependencies not rolled out: {}".format(
+                                ", ".join(failed)
+                            )
+                        else:
+                            future = pool.submit(_rollout, name, rendered[name])
+                            running[future] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+
+    return list(results.values())
+
+
+class RolloutFailed(RuntimeError):
+    pass
+
+
+def _instance_selector(names: dict) -> Optional[str]:
+    """Label selector matching the instance labels of `names`, when they all
+    have one"""
+    instances = set(names.values())
+    if None in instances:
+        return None
+    return f"{INSTANCE_LABEL} in ({','.join(sorted(instances))})"
 
 
 class HelmRelease(Base):
     resource_definitions: dict
+    _state: dict = PrivateAttr(default_factory=dict)
+    _versions: dict = PrivateAttr(default_factory=dict)
+    _lock: Condition = PrivateAttr(default_factory=Condition)
+    _stopped: Event = PrivateAttr(default_factory=Event)
+    _threads: list = PrivateAttr(default_factory=list)
 
     @classmethod
-    def load(cls, name) -> "HelmRelease":
+    def load(cls, name, timeout: Optional[float] = None) -> "HelmRelease":
+        """Release deployed as `name`, its manifests parsed one document at a
+        time while helm writes them"""
         command = ["helm", "get", "manifest", name]
         try:
-            yaml_resources = check_output(command, stderr=STDOUT)
+            with command_output(command, timeout=timeout, merge_stderr=False) as f:
+                resource_definitions = {
+                    f"{res['kind']}/{res['metadata']['name']}": res
+                    for res in yaml.load_all(f, Loader=YamlLoader)
+                    if res
+                }
         except CalledProcessError as e:
             print(e.output)
             raise e
 
-        return HelmRelease(
-            resource_definitions={
-                f"{res['kind']}/{res['metadata']['name']}": res
-                for res in yaml.safe_load_all(yaml_resources)
-            }
+        return HelmRelease(resource_definitions=resource_definitions)
+
+    @property
+    def resources(self) -> dict:
+        """Last known live state of the release resources, by `Kind/name`"""
+        with self._lock:
+            return dict(self._state)
+
+    def _groups(self) -> dict:
+        """Instance labels of the release resources by name, for each kind
+        and namespace"""
+        kinds = {kind._kind: kind for kind in POD_CONTROLLERS}
+        groups = {}
+        for definition in self.resource_definitions.values():
+            kind = kinds.get(definition["kind"])
+            if kind is None:
+                continue
+            metadata = definition["metadata"]
+            namespace = metadata.get("namespace") or "default"
+            labels = metadata.get("labels") or {}
+            groups.setdefault((kind, namespace), {})[metadata["name"]] = labels.get(
+                INSTANCE_LABEL
+            )
+        return groups
+
+    def refresh(self, timeout_seconds: int = 1):
+        """Update the cached state, listing each kind and namespace the first
+        time and only watching for changes since the last resourceVersion
+        afterwards.
+
+        Each watch lasts up to `timeout_seconds`, they run side by side. To
+        read the state often, `start()` the background watches once and read
+        `resources` instead.
+        """
+        groups = self._groups()
+        if not groups:
+            return
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            futures = [
+                pool.submit(self._sync, kind, namespace, names, timeout_seconds)
+                for (kind, namespace), names in groups.items()
+            ]
+            for future in futures:
+                future.result()
+
+    def _sync(self, kind, namespace: str, names: dict, timeout_seconds: int):
+        version = self._versions.get((kind, namespace))
+        if version is not None:
+            try:
+                return self._watch(kind, namespace, names, version, timeout_seconds)
+            except ApiException as e:
+                # 410 Gone, the resourceVersion is too old to resume from
+                if e.status != 410:
+                    raise
+
+        self._list(kind, namespace, names)
+
+    def _list(self, kind, namespace: str, names: dict):
+        lister = getattr(kind.kubernetes_api(), kind._api_list_loader)
+        listing = lister(namespace=namespace, label_selector=_instance_selector(names))
+        with self._lock:
+            for name in names:
+                self._state.pop(f"{kind._kind}/{name}", None)
+            for item in listing.items:
+                if item.metadata.name in names:
+                    self._state[f"{kind._kind}/{item.metadata.name}"] = item
+            self._versions[kind, namespace] = listing.metadata.resource_version
+            self._lock.notify_all()
+
+    def _watch(self, kind, namespace, names, version, timeout_seconds):
+        lister = getattr(kind.kubernetes_api(), kind._api_list_loader)
+        stream = watch.Watch().stream(
+            lister,
+            namespace=namespace,
+            label_selector=_instance_selector(names),
+            resource_version=version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=timeout_seconds,
         )
+        for event in stream:
+            metadata = event["raw_object"]["metadata"]
+            with self._lock:
+                self._versions[kind, namespace] = metadata["resourceVersion"]
+                name = metadata.get("name")
+                if event["type"] == "BOOKMARK" or name not in names:
+                    continue
+
+                key = f"{kind._kind}/{name}"
+                if event["type"] == "DELETED":
+                    self._state.pop(key, None)
+                else:
+                    self._state[key] = event["object"]
+                self._lock.notify_all()
+
+    def start(self, timeout_seconds: int = 5):
+        """Keep the cached state up to date from background threads, one
+        watch per kind and namespace"""
+        # Each start gets its own event, threads stopped without waiting for
+        # them never resume on a later start
+        stopped = self._stopped = Event()
+
+        def _loop(kind, namespace, names):
+            while not stopped.is_set():
+                try:
+                    self._sync(kind, namespace, names, timeout_seconds)
+                except Exception as e:
+                    # Keep watching, starting over from a fresh list
+                    process.output_logger(
+                        f"Watch of {kind._kind} in {namespace} failed: {e}"
+                    )
+                    with self._lock:
+                        self._versions.pop((kind, namespace), None)
+                    stopped.wait(timeout_seconds)
+
+        for (kind, namespace), names in self._groups().items():
+            self._sync(kind, namespace, names, timeout_seconds)
+            thread = Thread(target=_loop, args=(kind, namespace, names), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wait_until_ready(self, timeout: float = 300, watch_timeout: int = 5):
+        """Block until every resource of the release finished rolling out,
+        following their changes with one watch per kind and namespace. The
+        watches already running after `start()` are reused and left running.
+
+        Raises RolloutFailed when a rollout fails and TimeoutError when the
+        resources did not converge within `timeout` seconds.
+        """
+        kinds = {kind._kind: kind for kind in POD_CONTROLLERS}
+        pending = [
+            key for key in self.resource_definitions if key.split("/")[0] in kinds
+        ]
+        deadline = monotonic() + timeout
+        started = not self._threads
+        if started:
+            self.start(timeout_seconds=watch_timeout)
+        try:
+            with self._lock:
+                while True:
+                    not_ready = []
+                    for key in pending:
+                        kind = kinds[key.split("/")[0]]
+                        obj = self._state.get(key)
+                        failure = obj is not None and kind.rollout_failure(obj)
+                        if failure:
+                            raise RolloutFailed(f"{key}: {failure}")
+                        if obj is None or not kind.rollout_complete(obj):
+                            not_ready.append(key)
+
+                    if not not_ready:
+                        return self
+
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Rollout not ready after {}s: {}".format(
+                                timeout, ", ".join(not_ready)
+                            )
+                        )
+                    self._lock.wait(remaining)
+        finally:
+            if started:
+                # The watches end on their own within `watch_timeout`
+                self.stop(wait=False)
 
-    def refresh(self):
-        for name, resource in self.resource_definitions.keys():
-            pass
+    def stop(self, wait: bool = True):
+        """Stop the background watches. With `wait`, block until the pending
+        ones timed out, otherwise they end in the background."""
+        self._stopped.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
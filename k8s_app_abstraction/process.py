@@ -0,0 +1,122 @@
+"""Streaming execution of external commands such as helm.
+
+Output is forwarded line by line as the command writes it, to `print` by
+default or to the callable given to `set_output_logger()`::
+
+    set_output_logger(logging.getLogger("helm").info)
+
+Commands running longer than their `timeout` are killed and raise
+`subprocess.TimeoutExpired`, failed ones raise `CalledProcessError`.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen, TimeoutExpired
+from tempfile import TemporaryFile
+from threading import Event, Timer
+from typing import Callable, Iterator, List, Optional, TextIO
+
+# Lines of output attached to the errors of failed commands
+OUTPUT_TAIL_LINES = 20
+
+output_logger: Callable[[str], None] = print
+
+
+def set_output_logger(logger: Optional[Callable[[str], None]]):
+    """Forward the output lines of every command to `logger`, or to `print`"""
+    global output_logger
+    output_logger = logger or print
+
+
+def prefixed_logger(prefix: str) -> Callable[[str], None]:
+    """Logger forwarding to the output logger with lines starting by `prefix`,
+    to tell apart the output of commands running at the same time"""
+
+    def _log(line: str):
+        output_logger(f"{prefix}: {line}")
+
+    return _log
+
+
+@contextmanager
+def command_output(
+    command: List[str], timeout: Optional[float] = None, merge_stderr: bool = True
+) -> Iterator[TextIO]:
+    """Run `command` and give its stdout as a text stream read while the
+    command runs. Unless `merge_stderr` is set, stderr is spooled apart and
+    only surfaces in the raised `CalledProcessError`."""
+    stderr = STDOUT if merge_stderr else TemporaryFile()
+    process = Popen(command, stdout=PIPE, stderr=stderr, encoding="utf-8")
+    timed_out = Event()
+
+    def _kill():
+        timed_out.set()
+        process.kill()
+
+    timer = Timer(timeout, _kill) if timeout else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+
+    try:
+        with process.stdout:
+            try:
+                yield process.stdout
+            except Exception:
+                # Failures of the command prevail on the errors of its reader
+                try:
+                    returncode = process.wait(timeout=1)
+                except TimeoutExpired:
+                    returncode = None
+                if timed_out.is_set():
+                    raise TimeoutExpired(command, timeout)
+                if returncode:
+                    raise _failed(process, command, stderr)
+                raise
+        returncode = process.wait()
+        if timed_out.is_set():
+            raise TimeoutExpired(command, timeout)
+        if returncode:
+            raise _failed(process, command, stderr)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if stderr is not STDOUT:
+            stderr.close()
+
+
+def _failed(process: Popen, command: List[str], stderr) -> CalledProcessError:
+    output = None
+    if stderr is not STDOUT:
+        stderr.seek(0)
+        output = stderr.read().decode("utf-8", errors="replace")
+    return CalledProcessError(process.returncode, command, output=output)
+
+
+def stream_output(command: List[str], timeout: Optional[float] = None) -> Iterator[str]:
+    """Lines written by `command` on stdout and stderr, as they come"""
+    with command_output(command, timeout=timeout) as output:
+        for line in output:
+            yield line.rstrip("\n")
+
+
+def run_command(
+    command: List[str],
+    logger: Optional[Callable[[str], None]] = None,
+    timeout: Optional[float] = None,
+):
+    """Run `command`, forwarding its output to `logger` line by line. The
+    last lines are kept as the output of the `CalledProcessError` raised
+    when it fails."""
+    log = logger or output_logger
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    try:
+        for line in stream_output(command, timeout=timeout):
+            tail.append(line)
+            log(line)
+    except CalledProcessError as e:
+        e.output = "\n".join(tail)
+        raise
@@ -1,10 +1,31 @@
+import json
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from re import sub
+from threading import Lock, get_ident
+from time import time
+from typing import Callable, Hashable, NamedTuple, Optional
 from urllib.parse import urlparse
 
 import requests
 import yaml
 from jinja2 import BaseLoader, Environment
+from requests.adapters import HTTPAdapter
+
+from k8s_app_abstraction.instrumentation import span
+
+try:
+    # libyaml backed emitter, see `emitter_safe` for when it can be used
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper as YamlDumper
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader as YamlLoader
 
 
 def uri_validator(x):
@@ -15,63 +36,343 @@ def uri_validator(x):
         return False
 
 
-def merge(dict1, dict2):
-    for k in set(dict1.keys()).union(dict2.keys()):
-        if k in dict1 and k in dict2:
-            if isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
-                yield (k, dict(merge(dict1[k], dict2[k])))
+def merge(*dicts) -> dict:
+    """Deep merge `dicts`, values from later dicts override earlier ones.
+
+    Keys keep the order in which they first appear, and subtrees found in a
+    single dict are shared with the result rather than copied.
+    """
+    values = {}
+    for d in dicts:
+        for k, v in d.items():
+            if k in values and isinstance(v, dict) and isinstance(values[k][0], dict):
+                values[k].append(v)
             else:
                 # If one of the values is not a dict, you can't merge it.
-                # Value from second dict overrides one in first, then we
-                # move on.
-                yield (k, dict2[k])
-                # Alternatively, replace this with exception raiser to alert
-                # you of value conflicts
-        elif k in dict1:
-            yield (k, dict1[k])
-        else:
-            yield (k, dict2[k])
+                # Value from the later dict overrides the previous ones.
+                values[k] = [v]
 
+    return {k: v[0] if len(v) == 1 else merge(*v) for k, v in values.items()}
 
-def parse_yaml(content):
-    result = {}
+
+def diff_dicts(old, new, path: str = "") -> list:
+    """Dotted paths of the values that differ between `old` and `new`"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for k in list(old) + [k for k in new if k not in old]:
+            key = f"{path}.{k}" if path else str(k)
+            if k not in old or k not in new:
+                changes.append(key)
+            else:
+                changes.extend(diff_dicts(old[k], new[k], key))
+        return changes
+
+    return [] if old == new else [path]
+
+
+INCLUDE_WORKERS = 8
+
+_session = None
+_session_lock = Lock()
+
+
+def http_session() -> requests.Session:
+    """Shared session so remote includes reuse pooled connections"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=INCLUDE_WORKERS)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+class IncludeCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    revalidated: int
+
+
+class IncludeCache(object):
+    """On-disk cache of remote included files.
+
+    Remote files are keyed by URL and revalidated with ETag/Last-Modified
+    once `ttl` seconds have passed since they were fetched (always when no
+    `ttl` is given), the cached copy is used when revalidation fails. Local
+    files are read directly, a cached copy would cost more I/O than the file.
+    In `offline` mode cached remote files are used as they are and uncached
+    ones raise FileNotFoundError.
+    """
+
+    def __init__(self, directory: str, ttl: float = None, offline: bool = False):
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, sha256(key.encode("utf-8")).hexdigest())
+
+    def _read(self, key: str):
+        path = self._path(key)
+        try:
+            with open(f"{path}.json") as f:
+                meta = json.load(f)
+            with open(path, "rb") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def _write(self, key: str, meta: dict, content: bytes):
+        # Write to a temporary file and rename so concurrent readers never see
+        # a partial entry
+        path = self._path(key)
+        for filename, data in ((path, content), (f"{path}.json", json.dumps(meta))):
+            tmp = f"{filename}.{os.getpid()}.{get_ident()}.tmp"
+            with open(tmp, "wb" if isinstance(data, bytes) else "w") as f:
+                f.write(data)
+            os.replace(tmp, filename)
+
+    def load(self, filepath: str):
+        if uri_validator(filepath):
+            return self._load_url(filepath)
+
+        with open(filepath) as f:
+            return f.read()
+
+    def _load_url(self, url: str) -> bytes:
+        meta, content = self._read(url)
+        if content is not None:
+            fresh = self.ttl is not None and time() - meta["fetched_at"] < self.ttl
+            if self.offline or fresh:
+                self._count("hits")
+                return content
+        elif self.offline:
+            raise FileNotFoundError(f"{url} is not cached and offline mode is on")
+
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            response = http_session().get(url, headers=headers)
+        except requests.RequestException:
+            if content is None:
+                raise
+            # Unreachable server, serve the stale copy
+            self._count("hits")
+            return content
+
+        if content is not None and response.status_code == 304:
+            self._count("revalidated")
+            self._write(url, dict(meta, fetched_at=time()), content)
+            return content
+
+        if response.status_code != 200:
+            if content is None:
+                response.raise_for_status()
+                raise requests.HTTPError(
+                    f"Unexpected status {response.status_code} for {url}",
+                    response=response,
+                )
+            self._count("hits")
+            return content
+
+        self._count("misses")
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time(),
+        }
+        self._write(url, meta, response.content)
+        return response.content
+
+    def info(self) -> IncludeCacheInfo:
+        with self._lock:
+            return IncludeCacheInfo(self.hits, self.misses, self.revalidated)
+
+
+include_cache: Optional[IncludeCache] = None
+
+
+def set_include_cache(cache: Optional[IncludeCache]):
+    """Cache every included file through `cache`, or disable caching"""
+    global include_cache
+    include_cache = cache
+
+
+def load_yaml_file(filepath) -> str:
+    with span("load_include", name=filepath):
+        if include_cache is not None:
+            return include_cache.load(filepath)
+
+        if uri_validator(filepath):
+            return http_session().get(filepath).content
+
+        with open(filepath) as f:
+            return f.read()
+
+
+def fetch_yaml_files(paths) -> list:
+    """Load the content of every path concurrently, preserving their order"""
+    if len(paths) < 2:
+        return [load_yaml_file(path) for path in paths]
+
+    with ThreadPoolExecutor(max_workers=min(INCLUDE_WORKERS, len(paths))) as pool:
+        return list(pool.map(load_yaml_file, paths))
+
+
+class IncludeCycleError(ValueError):
+    pass
+
+
+def _parse_documents(content) -> list:
+    documents = []
     for partial in yaml.safe_load_all(content):
         if not partial:
             continue
 
         include = partial.pop("include", [])
-        included = {}
-        for child in include:
-            child_dict = dict(load_yaml_files(child))
-            included = dict(merge(included, child_dict))
-
+        documents.append((partial, include))
+
+    return documents
+
+
+def _resolve_includes(documents) -> dict:
+    # Fetch the include graph one level at a time, every new source of a
+    # level is loaded concurrently, and only once, before looking into the
+    # next one.
+    sources = {}
+    level = [documents]
+    while level:
+        paths = []
+        for level_documents in level:
+            for partial, include in level_documents:
+                for path in include:
+                    if path not in sources:
+                        sources[path] = None
+                        paths.append(path)
+
+        level = []
+        for path, content in zip(paths, fetch_yaml_files(paths)):
+            sources[path] = _parse_documents(content) if content else []
+            level.append(sources[path])
+
+    merged = {}
+    for path in _include_order(documents, sources):
+        merged[path] = _merge_documents(sources[path], merged)
+
+    return _merge_documents(documents, merged)
+
+
+def _include_order(documents, sources) -> list:
+    """Included sources sorted so every source comes after its own includes"""
+    order = []
+    done = set()
+    visiting = []
+
+    def _visit(documents):
+        for partial, include in documents:
+            for path in include:
+                if path in visiting:
+                    cycle = visiting[visiting.index(path) :] + [path]
+                    raise IncludeCycleError(
+                        "Include cycle detected: {}".format(" -> ".join(cycle))
+                    )
+
+                if path not in done:
+                    visiting.append(path)
+                    _visit(sources[path])
+                    visiting.pop()
+                    done.add(path)
+                    order.append(path)
+
+    _visit(documents)
+    return order
+
+
+def _merge_documents(documents, merged: dict) -> dict:
+    # Deep merge is not associative: the includes of a document are merged
+    # under it before the document is merged into the previous ones
+    result = {}
+    for partial, include in documents:
         if include:
-            partial = dict(merge(included, partial))
-
-        result = dict(merge(result, partial))
+            partial = merge(*(merged[path] for path in include), partial)
+        result = merge(result, partial)
 
     return {k: v for k, v in result.items() if not k.startswith(".")}
 
 
+def parse_yaml(content):
+    with span("parse_yaml"):
+        return _resolve_includes(_parse_documents(content))
+
+
 def load_yaml_files(*args):
-    def load_yaml_file(filepath) -> str:
-        if uri_validator(filepath):
-            return requests.get(filepath).content
+    with span("load_yaml_files"):
+        return _resolve_includes(
+            [
+                document
+                for content in fetch_yaml_files(list(args))
+                if content
+                for document in _parse_documents(content)
+            ]
+        )
+
+
+def _camelize(key) -> str:
+    enumerated = enumerate(key.lower().split("_"))
+    return "".join(_ if i == 0 else _.capitalize() for i, _ in enumerated)
 
-        with open(filepath) as f:
-            return f.read()
 
-    def _load_all_files():
-        for filepath in args:
-            yield load_yaml_file(filepath)
+def _kubernetes_keys():
+    """snake_case attribute names of every kubernetes client model, with
+    their camelCase manifest keys"""
+    from kubernetes.client import models
+
+    for model in vars(models).values():
+        attribute_map = getattr(model, "attribute_map", None)
+        if isinstance(attribute_map, dict):
+            yield from attribute_map.items()
+
+
+CAMELIZED_KEYS_MAXSIZE = 16384
+_camelized_keys = {}
+
 
-    return parse_yaml("\n---\n".join(_ for _ in _load_all_files() if _))
+def camelized_keys() -> dict:
+    """Translation table for the keys found in kubernetes manifests. Keys
+    already camelized, as `generate()` emits them, are kept unchanged."""
+    if not _camelized_keys:
+        keys = list(_kubernetes_keys())
+        table = {camel: camel for _, camel in keys}
+        table.update((k, _camelize(k)) for k, _ in keys)
+        _camelized_keys.update(table)
+    return _camelized_keys
 
 
 def camelize(key) -> str:
     """camelCase given key"""
-    enumerated = enumerate(key.lower().split("_"))
-    return "".join(_ if i == 0 else _.capitalize() for i, _ in enumerated)
+    table = _camelized_keys or camelized_keys()
+    try:
+        return table[key]
+    except KeyError:
+        camelized = _camelize(key)
+        if len(table) < CAMELIZED_KEYS_MAXSIZE:
+            table[key] = camelized
+        return camelized
 
 
 def snakelize(s):
@@ -82,25 +383,84 @@ def snakelize(s):
     ).lower()
 
 
-def dict_to_yaml(data, context: dict = None):
-    def _format(res):
-        if isinstance(res, dict):
-            new = {}
-            for k, v in res.items():
-                k = camelize(k)
-                if v is not None:
-                    new[k] = _format(v)
-            return new
+def emitter_safe(value) -> bool:
+    """Whether libyaml emits ``value`` exactly as the pure python emitter does.
+
+    Both emitters only disagree on how long double-quoted scalars are folded,
+    and printable ascii strings are never emitted double-quoted.
+    """
+    return not isinstance(value, str) or (value.isascii() and value.isprintable())
 
-        if isinstance(res, list):
-            return [_format(_) for _ in res]
+
+def _format(data, context: dict, camelize_keys: bool):
+    c_safe = True
+
+    def _scalar(res):
+        nonlocal c_safe
 
         if isinstance(res, LazyString):
-            return res.render(context)
+            res = res.render(context)
 
+        c_safe = c_safe and emitter_safe(res)
         return res
 
-    return yaml.safe_dump(_format(data))
+    def _container(res):
+        return {} if isinstance(res, dict) else []
+
+    # Walk the document iteratively, nested containers get an empty copy
+    # in place and are filled once popped from the pending stack.
+    formatted = _container(data) if isinstance(data, (dict, list)) else None
+    pending = [(data, formatted)] if formatted is not None else []
+    while pending:
+        res, new = pending.pop()
+        if isinstance(res, dict):
+            for k, v in res.items():
+                if v is None:
+                    continue
+
+                if camelize_keys:
+                    k = camelize(k)
+                c_safe = c_safe and emitter_safe(k)
+                if isinstance(v, (dict, list)):
+                    new[k] = _container(v)
+                    pending.append((v, new[k]))
+                else:
+                    new[k] = _scalar(v)
+        else:
+            for v in res:
+                if isinstance(v, (dict, list)):
+                    new.append(_container(v))
+                    pending.append((v, new[-1]))
+                else:
+                    new.append(_scalar(v))
+
+    if formatted is None:
+        formatted = _scalar(data)
+
+    return formatted, c_safe
+
+
+def format_manifest(data, context: dict = None, camelize_keys: bool = True):
+    """`data` as it would be dumped by `dict_to_yaml`, lazy strings rendered"""
+    with span("format"):
+        return _format(data, context, camelize_keys)[0]
+
+
+def dict_to_yaml(
+    data,
+    context: dict = None,
+    dumper: type = None,
+    camelize_keys: bool = True,
+    stream=None,
+):
+    with span("format"):
+        formatted, c_safe = _format(data, context, camelize_keys)
+
+    if dumper is None:
+        dumper = YamlDumper if c_safe else yaml.SafeDumper
+
+    with span("emit"):
+        return yaml.dump(formatted, stream, Dumper=dumper)
 
 
 class Context(object):
@@ -113,6 +473,87 @@ class Context(object):
     def prefix(self, name):
         return f"{self.context['stack'].name}-{name}"
 
+    @property
+    def fingerprint(self):
+        """Everything rendering reads from the context, as a cache key"""
+        if not self.context or self.context.get("stack") is None:
+            return None
+        return self.context["stack"].name
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+_missing = object()
+
+
+class LRUCache(object):
+    """Bounded, thread safe LRU cache counting its hits and misses"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def lookup(self, key: Hashable, default=None):
+        with self._lock:
+            value = self._values.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._values.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def get(self, key: Hashable, compute: Callable):
+        value = self.lookup(key, _missing)
+        if value is _missing:
+            # Computed outside of the lock, a concurrent miss on the same key
+            # computes twice but both results are equivalent.
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._values))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class TemplateCache(LRUCache):
+    """Bounded LRU cache of compiled jinja templates keyed by source"""
+
+    def __init__(self, environment: Environment, maxsize: int = 1024):
+        super(TemplateCache, self).__init__(maxsize)
+        self.environment = environment
+
+    def get(self, source: str):
+        return super(TemplateCache, self).get(
+            source, lambda: self.environment.from_string(source)
+        )
+
+
+environment = Environment(loader=BaseLoader)
+template_cache = TemplateCache(environment)
+
 
 class LazyString(str):
 
@@ -122,7 +563,7 @@ class LazyString(str):
         return self
 
     def render(self, context):
-        rtemplate = Environment(loader=BaseLoader).from_string(self.get_template())
+        rtemplate = template_cache.get(str(self.get_template()))
 
         context = Context(context)
 
@@ -132,3 +573,7 @@ class LazyString(str):
 class Prefixed(LazyString):
     def get_template(self):
         return "{{ prefix('%s') }}" % self
+
+    def render(self, context):
+        # Trivial `prefix('<name>')` template, no need to go through jinja
+        return Context(context).prefix(str(self))
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+from k8s_app_abstraction.cluster import ClusterSession, set_session
+from tests.fake_helm import FakeHelm
+from tests.fake_kubernetes import FakeKubernetes
+
+
+@pytest.fixture
+def fake_kubernetes():
+    """Point the cluster session to a fake API server"""
+    fake = FakeKubernetes().start()
+    session = ClusterSession(configuration=fake.configuration())
+    previous = set_session(session)
+    yield fake
+    set_session(previous)
+    session.close()
+    fake.stop()
+
+
+@pytest.fixture
+def fake_helm(tmp_path, monkeypatch):
+    """Put a fake `helm` executable first on the PATH"""
+    if sys.platform == "win32":
+        # Windows only runs `helm.exe` from the PATH, not scripts
+        pytest.skip("the fake helm is a python script")
+    fake = FakeHelm(str(tmp_path / "helm"))
+    monkeypatch.setenv("PATH", fake.bin + os.pathsep + os.environ["PATH"])
+    return fake
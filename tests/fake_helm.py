@@ -0,0 +1,124 @@
+"""Fake `helm` executable put first on the PATH by the `fake_helm` fixture.
+
+It understands `upgrade --install`, `get manifest` and `delete`, keeps the
+installed manifests in its state folder and records every call in
+`FakeHelm.calls`, with their start and end times in `FakeHelm.timings`.
+Environment variables tune its behaviour:
+
+- FAKE_HELM_SLEEP: seconds to sleep during `upgrade`
+- FAKE_HELM_FAIL: comma separated release names whose `upgrade` fails
+"""
+
+import json
+import os
+import stat
+import sys
+
+SCRIPT = """#!{python}
+import atexit, glob, json, os, sys, tarfile, time
+
+state = {state!r}
+args = sys.argv[1:]
+started = time.time()
+with open(os.path.join(state, "calls.jsonl"), "a") as f:
+    f.write(json.dumps(args) + "\\n")
+
+
+@atexit.register
+def _timing():
+    with open(os.path.join(state, "timings.jsonl"), "a") as f:
+        f.write(json.dumps([args, started, time.time()]) + "\\n")
+
+
+def release(name):
+    return os.path.join(state, name + ".yaml")
+
+
+if args[:2] == ["upgrade", "--install"]:
+    name, location = args[2], args[3]
+    print("Release " + repr(name) + " is being upgraded", flush=True)
+    time.sleep(float(os.environ.get("FAKE_HELM_SLEEP") or 0))
+    if name in (os.environ.get("FAKE_HELM_FAIL") or "").split(","):
+        print("Error: UPGRADE FAILED: " + name, file=sys.stderr)
+        sys.exit(1)
+    if os.path.isdir(location):
+        templates = {{}}
+        for path in glob.glob(os.path.join(location, "templates", "*")):
+            with open(path) as f:
+                templates[os.path.basename(path)] = f.read()
+    else:
+        with tarfile.open(location) as tar:
+            templates = {{
+                m.name.split("/templates/")[1]: tar.extractfile(m).read().decode()
+                for m in tar.getmembers()
+                if "/templates/" in m.name
+            }}
+    with open(release(name), "w") as out:
+        for source, content in sorted(templates.items()):
+            out.write("---\\n# Source: " + name + "/templates/" + source + "\\n")
+            out.write(content)
+    print("Release " + repr(name) + " has been upgraded. Happy Helming!")
+elif args[:2] == ["get", "manifest"]:
+    if not os.path.exists(release(args[2])):
+        print("Error: release: not found", file=sys.stderr)
+        sys.exit(1)
+    with open(release(args[2])) as f:
+        sys.stdout.write(f.read())
+elif args[:1] == ["delete"]:
+    os.remove(release(args[1]))
+    print("release " + repr(args[1]) + " uninstalled")
+else:
+    print("Error: unknown command " + " ".join(args), file=sys.stderr)
+    sys.exit(1)
+"""
+
+
+class FakeHelm(object):
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.bin = os.path.join(folder, "bin")
+        self.state = os.path.join(folder, "state")
+        os.makedirs(self.bin)
+        os.makedirs(self.state)
+        executable = os.path.join(self.bin, "helm")
+        with open(executable, "w") as f:
+            f.write(SCRIPT.format(python=sys.executable, state=self.state))
+        os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+
+    @property
+    def calls(self) -> list:
+        try:
+            with open(os.path.join(self.state, "calls.jsonl")) as f:
+                return [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return []
+
+    @property
+    def timings(self) -> list:
+        """`(args, start, end)` of every finished call"""
+        try:
+            with open(os.path.join(self.state, "timings.jsonl")) as f:
+                return [tuple(json.loads(line)) for line in f]
+        except FileNotFoundError:
+            return []
+
+    def max_concurrent_upgrades(self) -> int:
+        """Most upgrades running at the same time"""
+        events = []
+        for args, start, end in self.timings:
+            if args[:2] == ["upgrade", "--install"]:
+                events += [(start, 1), (end, -1)]
+        running = peak = 0
+        # Ends sort before starts at the same time
+        for _, delta in sorted(events):
+            running += delta
+            peak = max(peak, running)
+        return peak
+
+    def install(self, name: str, manifests: str):
+        with open(os.path.join(self.state, f"{name}.yaml"), "w") as f:
+            f.write(manifests)
+
+    def manifests(self, name: str) -> str:
+        with open(os.path.join(self.state, f"{name}.yaml")) as f:
+            return f.read()
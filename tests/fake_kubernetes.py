@@ -0,0 +1,298 @@
+"""Minimal in-process fake of the kubernetes API server used by the tests.
+
+Only the `apps/v1` namespaced resources are implemented: read, list with
+label selectors, watch, server-side apply and delete. Every request is
+recorded in `FakeKubernetes.requests` as a `(method, path, query)` tuple.
+"""
+
+import json
+import re
+import threading
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import kubernetes
+import yaml
+from kubernetes import client
+
+PLURALS = {
+    "deployments": "Deployment",
+    "daemonsets": "DaemonSet",
+    "statefulsets": "StatefulSet",
+}
+
+PATH = re.compile(
+    r"^/apis/apps/v1(?:/namespaces/(?P<namespace>[^/]+))?"
+    r"/(?P<plural>[a-z]+)(?:/(?P<name>[^/]+))?$"
+)
+
+
+def match_selector(labels: dict, selector: str) -> bool:
+    for term in re.findall(r"[^,(]+(?:\([^)]*\))?", selector or ""):
+        term = term.strip().replace("==", "=")
+        found = re.match(r"^(\S+)\s+(in|notin)\s+\((.*)\)$", term)
+        if found:
+            key, operator, values = found.groups()
+            values = {v.strip() for v in values.split(",")}
+            if (labels.get(key) in values) != (operator == "in"):
+                return False
+        elif "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif labels.get(term) is None:
+            return False
+    return True
+
+
+class FakeKubernetes(object):
+    def __init__(self):
+        self.objects = {}
+        self.events = []
+        self.requests = []
+        self.resource_version = 0
+        self.stopped = False
+        # Compatible with the installed library, see HelmChart.check_compatibility
+        self.git_version = "v1.{}.0".format(kubernetes.__version__.split(".")[0])
+        self.condition = threading.Condition()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def configuration(self) -> client.Configuration:
+        configuration = client.Configuration()
+        configuration.host = self.url
+        return configuration
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def requests_for(self, method: str, path: str = "") -> list:
+        return [r for r in self.requests if r[0] == method and path in r[1]]
+
+    # Storage
+
+    def _key(self, plural, namespace, name):
+        return (plural, namespace, name)
+
+    def put(self, plural: str, manifest: dict, event: str = None) -> dict:
+        """Create or replace an object, bumping generation on spec changes"""
+        manifest = deepcopy(manifest)
+        metadata = manifest.setdefault("metadata", {})
+        namespace = metadata.setdefault("namespace", "default")
+        key = self._key(plural, namespace, metadata["name"])
+        with self.condition:
+            current = self.objects.get(key)
+            self.resource_version += 1
+            metadata["resourceVersion"] = str(self.resource_version)
+            if current is None:
+                metadata["generation"] = 1
+                metadata["uid"] = "uid-{}".format(self.resource_version)
+            else:
+                metadata["uid"] = current["metadata"]["uid"]
+                generation = current["metadata"]["generation"]
+                if current.get("spec") != manifest.get("spec"):
+                    generation += 1
+                metadata["generation"] = generation
+                if "status" not in manifest and "status" in current:
+                    manifest["status"] = current["status"]
+            self.objects[key] = manifest
+            self.events.append(
+                (
+                    self.resource_version,
+                    plural,
+                    event or ("ADDED" if current is None else "MODIFIED"),
+                    deepcopy(manifest),
+                )
+            )
+            self.condition.notify_all()
+        return manifest
+
+    def set_status(self, plural: str, namespace: str, name: str, **status):
+        with self.condition:
+            manifest = deepcopy(self.objects[self._key(plural, namespace, name)])
+        manifest["status"] = dict(manifest.get("status") or {}, **status)
+        return self.put(plural, manifest, event="MODIFIED")
+
+    def delete(self, plural: str, namespace: str, name: str):
+        with self.condition:
+            manifest = self.objects.pop(self._key(plural, namespace, name))
+            self.resource_version += 1
+            manifest["metadata"]["resourceVersion"] = str(self.resource_version)
+            self.events.append((self.resource_version, plural, "DELETED", manifest))
+            self.condition.notify_all()
+        return manifest
+
+    def list(self, plural: str, namespace: str = None, selector: str = None) -> list:
+        with self.condition:
+            return [
+                deepcopy(obj)
+                for (p, ns, _), obj in sorted(self.objects.items())
+                if p == plural
+                and (namespace is None or ns == namespace)
+                and match_selector(obj["metadata"].get("labels") or {}, selector)
+            ]
+
+    # HTTP
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.0"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _not_found(self, name):
+                self._send(
+                    404,
+                    {
+                        "kind": "Status",
+                        "apiVersion": "v1",
+                        "status": "Failure",
+                        "reason": "NotFound",
+                        "message": f"{name} not found",
+                        "code": 404,
+                    },
+                )
+
+            def _route(self, method):
+                url = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                fake.requests.append((method, url.path, query))
+                if url.path.rstrip("/") == "/version":
+                    return self._send(
+                        200,
+                        {
+                            "major": "1",
+                            "minor": fake.git_version.split(".")[1],
+                            "gitVersion": fake.git_version,
+                            "gitCommit": "0" * 40,
+                            "gitTreeState": "clean",
+                            "buildDate": "2024-01-01T00:00:00Z",
+                            "goVersion": "go1.22.0",
+                            "compiler": "gc",
+                            "platform": "linux/amd64",
+                        },
+                    )
+
+                found = PATH.match(url.path)
+                if not found or found.group("plural") not in PLURALS:
+                    return self._not_found(url.path)
+
+                return getattr(self, f"_{method.lower()}")(query, **found.groupdict())
+
+            def _get(self, query, namespace, plural, name):
+                if name is not None:
+                    obj = fake.objects.get(fake._key(plural, namespace, name))
+                    if obj is None:
+                        return self._not_found(name)
+                    return self._send(200, obj)
+
+                if query.get("watch") in ("true", "1", "True"):
+                    return self._watch(query, namespace, plural)
+
+                items = fake.list(plural, namespace, query.get("labelSelector"))
+                self._send(
+                    200,
+                    {
+                        "kind": PLURALS[plural] + "List",
+                        "apiVersion": "apps/v1",
+                        "metadata": {"resourceVersion": str(fake.resource_version)},
+                        "items": items,
+                    },
+                )
+
+            def _watch(self, query, namespace, plural):
+                since = int(query.get("resourceVersion") or 0)
+                timeout = float(query.get("timeoutSeconds") or 1)
+                selector = query.get("labelSelector")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+
+                def _write(event):
+                    self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+
+                with fake.condition:
+                    fake.condition.wait_for(
+                        lambda: any(e[0] > since for e in fake.events) or fake.stopped,
+                        timeout=timeout,
+                    )
+                    events = [e for e in fake.events if e[0] > since]
+
+                for version, event_plural, kind, obj in events:
+                    metadata = obj["metadata"]
+                    if event_plural != plural:
+                        continue
+                    if namespace is not None and metadata["namespace"] != namespace:
+                        continue
+                    if not match_selector(metadata.get("labels") or {}, selector):
+                        continue
+                    _write({"type": kind, "object": obj})
+
+                if query.get("allowWatchBookmarks") in ("true", "True"):
+                    _write(
+                        {
+                            "type": "BOOKMARK",
+                            "object": {
+                                "kind": PLURALS[plural],
+                                "apiVersion": "apps/v1",
+                                "metadata": {
+                                    "resourceVersion": str(fake.resource_version)
+                                },
+                            },
+                        }
+                    )
+
+            def _patch(self, query, namespace, plural, name):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = yaml.safe_load(self.rfile.read(length))
+                body.setdefault("metadata", {})["namespace"] = namespace
+                if body["metadata"].get("name") != name:
+                    return self._not_found(name)
+                self._send(200, fake.put(plural, body))
+
+            def _delete(self, query, namespace, plural, name):
+                if fake._key(plural, namespace, name) not in fake.objects:
+                    return self._not_found(name)
+                fake.delete(plural, namespace, name)
+                self._send(200, {"kind": "Status", "status": "Success"})
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_PATCH(self):
+                self._route("PATCH")
+
+            def do_DELETE(self):
+                self._route("DELETE")
+
+        return Handler
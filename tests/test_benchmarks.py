@@ -0,0 +1,9 @@
+from benchmarks import suite
+
+ARGS = ["--sizes", "3", "--depths", "1", "--number", "1"]
+
+
+def test_benchmark_suite_smoke(tmpdir):
+    output = str(tmpdir.join("results.json"))
+    assert suite.main(ARGS + ["--output", output]) == 0
+    assert suite.main(ARGS + ["--baseline", output, "--threshold", "1000"]) == 0
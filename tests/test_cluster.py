@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+from kubernetes import client
+
+from k8s_app_abstraction.cluster import ClusterSession, get_session
+from k8s_app_abstraction.models.pod_controllers import (
+    Daemonset,
+    Deployment,
+    Statefulset,
+)
+
+
+def test_session_shared_api_client(fake_kubernetes):
+    session = get_session()
+    apis = {cls.kubernetes_api() for cls in (Deployment, Daemonset, Statefulset)}
+    assert len(apis) == 1
+    assert apis.pop().api_client is session.api_client
+    assert session.api_client.configuration.connection_pool_maxsize == 16
+
+
+def test_session_version_ttl(fake_kubernetes):
+    session = ClusterSession(
+        configuration=fake_kubernetes.configuration(), version_ttl=0
+    )
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: session.check_compatibility(), range(8)))
+    assert len(fake_kubernetes.requests_for("GET", "/version")) == 8
+
+    session = ClusterSession(configuration=fake_kubernetes.configuration())
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: session.check_compatibility(), range(8)))
+    assert len(fake_kubernetes.requests_for("GET", "/version")) == 9
+    session.close()
+
+
+def test_session_version_fetched_without_lock(fake_kubernetes):
+    session = ClusterSession(configuration=fake_kubernetes.configuration())
+    fetching, release = threading.Event(), threading.Event()
+    get_code = client.VersionApi.get_code
+
+    def slow_get_code(api):
+        fetching.set()
+        release.wait(5)
+        return get_code(api)
+
+    with mock.patch.object(client.VersionApi, "get_code", slow_get_code):
+        with ThreadPoolExecutor(2) as pool:
+            version = pool.submit(session.version)
+            assert fetching.wait(5)
+            # Other threads use the session while the version is fetched
+            api = pool.submit(session.api, client.AppsV1Api)
+            try:
+                assert api.result(timeout=1) is not None
+            finally:
+                release.set()
+            assert version.result().minor
+    session.close()
+
+
+def test_session_incompatible(fake_kubernetes):
+    fake_kubernetes.git_version = "v1.2.0"
+    session = ClusterSession(configuration=fake_kubernetes.configuration())
+    with pytest.raises(AssertionError, match="v1.2.0"):
+        session.check_compatibility()
+
+
+def test_session_close(fake_kubernetes):
+    session = ClusterSession(configuration=fake_kubernetes.configuration(), pool_size=2)
+    api = session.api(client.AppsV1Api)
+    assert session.api(client.AppsV1Api) is api
+    session.close()
+    assert session.api(client.AppsV1Api) is not api
+    assert session.api_client.configuration.connection_pool_maxsize == 2
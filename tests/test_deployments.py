@@ -9,6 +9,7 @@ from k8s_app_abstraction.models.pod_controllers import (
     Statefulset,
 )
 from k8s_app_abstraction.models.stack import Stack
+from k8s_app_abstraction.utils import dict_to_yaml
 
 
 def test_deployment():
@@ -117,3 +118,23 @@ def test_daemonset_yaml_invalid():
         )
 
     assert e.value.errors()[0]["msg"] == "Invalid value for DaemonsetList"
+
+
+@pytest.mark.parametrize("model", [Deployment, Daemonset, Statefulset])
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"image": "my/image"},
+        {"image": "my/image", "command": ["run"], "entrypoint": ["sh", "-c"]},
+        {"image": "my/image", "namespace": "other", "replicas": 4},
+    ],
+)
+def test_generate_matches_client_model(model, fields):
+    stack = Stack(name="yaml-stack")
+    resource = model(name="foo", **fields)
+
+    assert dict_to_yaml(
+        resource.to_client_model().to_dict(), context={"stack": stack}
+    ) == dict_to_yaml(
+        resource.generate(), context={"stack": stack}, camelize_keys=False
+    )
@@ -0,0 +1,136 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import pytest
+import requests
+
+from k8s_app_abstraction.models.stack import Stack
+from k8s_app_abstraction.utils import IncludeCache, set_include_cache
+
+REMOTE_YAML = b"""
+deployments:
+  remote:
+    image: remote/image
+"""
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    status = None
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("If-None-Match"))
+        if self.status is not None:
+            self.send_response(self.status)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"oops:")
+            return
+
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(REMOTE_YAML)))
+        self.end_headers()
+        self.wfile.write(REMOTE_YAML)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    StubHandler.requests = []
+    StubHandler.status = None
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/base.yml"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def cache_dir():
+    with TemporaryDirectory() as location:
+        yield location
+    set_include_cache(None)
+
+
+def test_remote_include_revalidation(server, cache_dir):
+    cache = IncludeCache(cache_dir)
+    set_include_cache(cache)
+    definition = f"include:\n- {server}\n"
+
+    for _ in range(3):
+        stack = Stack.new(name="test", definition=definition)
+        assert stack.deployments[0].image == "remote/image"
+
+    assert StubHandler.requests == [None, '"v1"', '"v1"']
+    assert cache.info() == (0, 1, 2)
+
+
+def test_remote_include_ttl_and_offline(server, cache_dir):
+    set_include_cache(IncludeCache(cache_dir, ttl=60))
+    definition = f"include:\n- {server}\n"
+
+    Stack.new(name="test", definition=definition)
+    Stack.new(name="test", definition=definition)
+    assert len(StubHandler.requests) == 1
+
+    offline = IncludeCache(cache_dir, offline=True)
+    set_include_cache(offline)
+    stack = Stack.new(name="test", definition=definition)
+    assert stack.deployments[0].image == "remote/image"
+    assert offline.info().hits == 1
+    assert len(StubHandler.requests) == 1
+
+    with pytest.raises(FileNotFoundError):
+        Stack.new(name="test", definition=f"include:\n- {server}?other\n")
+
+
+def test_local_include_read_directly(cache_dir):
+    cache = IncludeCache(os.path.join(cache_dir, "cache"))
+    set_include_cache(cache)
+    local = os.path.join(cache_dir, "local.yml")
+    with open(local, "w") as f:
+        f.write("deployments:\n  local:\n    image: v1\n")
+
+    assert Stack.new("test", f"include:\n- {local}\n").deployments[0].image == "v1"
+
+    with open(local, "w") as f:
+        f.write("deployments:\n  local:\n    image: v2\n")
+    os.utime(local, ns=(0, 0))
+
+    assert Stack.new("test", f"include:\n- {local}\n").deployments[0].image == "v2"
+    assert cache.info() == (0, 0, 0)
+    assert os.listdir(os.path.join(cache_dir, "cache")) == []
+
+
+def test_remote_include_revalidation_failure(server, cache_dir):
+    cache = IncludeCache(cache_dir)
+    set_include_cache(cache)
+    definition = f"include:\n- {server}\n"
+    Stack.new(name="test", definition=definition)
+
+    StubHandler.status = 500
+    stack = Stack.new(name="test", definition=definition)
+    assert stack.deployments[0].image == "remote/image"
+
+    with pytest.raises(requests.HTTPError):
+        Stack.new(name="test", definition=f"include:\n- {server}?other\n")
+
+    with mock.patch("requests.Session.get", side_effect=requests.ConnectionError):
+        stack = Stack.new(name="test", definition=definition)
+        assert stack.deployments[0].image == "remote/image"
+
+        with pytest.raises(requests.ConnectionError):
+            Stack.new(name="test", definition=f"include:\n- {server}?other\n")
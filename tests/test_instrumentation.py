@@ -0,0 +1,56 @@
+import tracemalloc
+from tempfile import TemporaryDirectory
+
+from k8s_app_abstraction import instrumentation
+from k8s_app_abstraction.instrumentation import add_listener, remove_listener, span
+from k8s_app_abstraction.models.stack import Stack
+
+DEFINITION = """
+deployments:
+  app:
+    image: awesome/app
+statefulsets:
+  db:
+    image: postgres
+"""
+
+
+def test_disabled_spans_are_shared_noops():
+    assert span("render") is span("generate", kind="Deployment", name="app")
+
+
+def test_listener_receives_spans():
+    events = []
+
+    def listener(event, span):
+        events.append((event, span.phase, span.kind, span.name, span))
+
+    add_listener(listener, trace_memory=True)
+    try:
+        stack = Stack.new(name="my-stack", definition=DEFINITION)
+        stack.to_yaml()
+        with TemporaryDirectory() as location:
+            stack.chart.dump(location)
+    finally:
+        remove_listener(listener)
+
+    ended = [e for e in events if e[0] == "end"]
+    assert len(ended) * 2 == len(events)
+    assert ("parse_yaml", None, None) == ended[0][1:4]
+    assert ("validate", "Stack", "my-stack") == ended[1][1:4]
+
+    phases = {(phase, kind, name) for _, phase, kind, name, _ in ended}
+    assert ("generate", "Deployment", "app") in phases
+    assert ("generate", "StatefulSet", "db") in phases
+    assert ("render", "StatefulSet", "db") in phases
+    assert ("format", None, None) in phases
+    assert ("emit", None, None) in phases
+    assert ("dump", "HelmChart", "my-stack") in phases
+
+    for _, _, _, _, measured in ended:
+        assert measured.duration >= 0
+        assert measured.memory_delta is not None
+
+    assert not instrumentation._listeners
+    assert not instrumentation._trace_memory
+    assert not tracemalloc.is_tracing()
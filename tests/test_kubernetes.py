@@ -0,0 +1,373 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import yaml
+from kubernetes.client.rest import ApiException
+
+from k8s_app_abstraction.models.pod_controllers import (
+    Daemonset,
+    Deployment,
+    Statefulset,
+)
+from k8s_app_abstraction.models.stack import (
+    HelmRelease,
+    RolloutFailed,
+    Stack,
+    gather_kubernetes_resources,
+)
+
+PLURALS = {
+    "Deployment": "deployments",
+    "DaemonSet": "daemonsets",
+    "StatefulSet": "statefulsets",
+}
+
+
+def make_stack(name="my-stack", deployments=3):
+    return Stack(
+        name=name,
+        deployments=[
+            Deployment(name=f"deploy-{i}", image="bar") for i in range(deployments)
+        ]
+        + [Deployment(name="other-ns", image="bar", namespace="other")],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+        statefulsets=[Statefulset(name="a-statefulset", image="bar", replicas=2)],
+    )
+
+
+def deploy(fake, stack):
+    """Store the manifests of `stack` in the fake API server"""
+    for manifest in yaml.safe_load_all(stack.to_yaml()):
+        fake.put(PLURALS[manifest["kind"]], manifest)
+
+
+def test_get_kubernetes_resources_batched(fake_kubernetes):
+    stack = make_stack()
+    deploy(fake_kubernetes, stack)
+    # Same resource names in another stack must not be mixed up
+    deploy(fake_kubernetes, make_stack(name="neighbour"))
+
+    serial = list(stack.chart.get_kubernetes_resources())
+    reads = len(fake_kubernetes.requests)
+    assert reads == 6
+
+    batched = list(stack.chart.get_kubernetes_resources(batched=True))
+    assert len(fake_kubernetes.requests) - reads == 4
+    assert [r.metadata.name for r in batched] == [r.metadata.name for r in serial]
+    assert [r.metadata.namespace for r in batched] == [
+        "default",
+        "default",
+        "default",
+        "other",
+        "default",
+        "default",
+    ]
+    assert batched[-1].spec.replicas == 2
+
+
+def test_get_kubernetes_resources_batched_missing(fake_kubernetes):
+    stack = make_stack()
+    deploy(fake_kubernetes, stack)
+    fake_kubernetes.delete("daemonsets", "default", "my-stack-a-daemonset")
+
+    with pytest.raises(ApiException) as err:
+        list(stack.chart.get_kubernetes_resources(batched=True))
+
+    assert err.value.status == 404
+
+
+def test_aget_from_kubernetes(fake_kubernetes):
+    stack = make_stack()
+    deploy(fake_kubernetes, stack)
+
+    async def _get():
+        return await stack.statefulsets[0].aget_from_kubernetes(stack=stack)
+
+    assert asyncio.run(_get()).metadata.name == "my-stack-a-statefulset"
+
+
+def test_aget_kubernetes_resources(fake_kubernetes):
+    stack = make_stack()
+    deploy(fake_kubernetes, stack)
+
+    async def _collect():
+        return [res async for res in stack.chart.aget_kubernetes_resources()]
+
+    resources = asyncio.run(_collect())
+    assert [r.metadata.name for r in resources] == [
+        r.metadata.name for r in stack.chart.get_kubernetes_resources()
+    ]
+
+
+def test_gather_kubernetes_resources(fake_kubernetes):
+    stacks = [make_stack(name=f"stack-{i}", deployments=i + 1) for i in range(4)]
+    for stack in stacks:
+        deploy(fake_kubernetes, stack)
+
+    results = asyncio.run(
+        gather_kubernetes_resources(*(s.chart for s in stacks), concurrency=3)
+    )
+
+    assert [len(resources) for resources in results] == [4, 5, 6, 7]
+    assert results[2][0].metadata.name == "stack-2-deploy-0"
+
+
+def test_apply(fake_kubernetes):
+    stack = make_stack()
+    neighbour = make_stack(name="neighbour")
+    neighbour.chart.apply()
+
+    result = stack.chart.apply()
+    assert result.applied[0] == "Deployment/default/my-stack-deploy-0"
+    assert "Deployment/other/my-stack-other-ns" in result.applied
+    assert result.pruned == []
+    assert len(fake_kubernetes.requests_for("PATCH")) == 12
+
+    applied = fake_kubernetes.objects[
+        "statefulsets", "default", "my-stack-a-statefulset"
+    ]
+    assert applied["spec"]["replicas"] == 2
+    assert applied["metadata"]["labels"]["app.kubernetes.io/part-of"] == "my-stack"
+    assert "app.kubernetes.io/part-of" not in applied["spec"]["selector"]["matchLabels"]
+
+    stack.deployments.pop(0)
+    stack.daemonsets.pop()
+    result = stack.chart.apply()
+    assert result.pruned == [
+        "Deployment/default/my-stack-deploy-0",
+        "DaemonSet/default/my-stack-a-daemonset",
+    ]
+    assert (
+        "deployments",
+        "default",
+        "my-stack-deploy-0",
+    ) not in fake_kubernetes.objects
+    assert ("deployments", "default", "neighbour-deploy-0") in fake_kubernetes.objects
+
+
+def test_apply_prunes_own_namespaces_only(fake_kubernetes):
+    # Same stack name, managed by another team in its own namespace
+    Stack(
+        name="my-stack",
+        deployments=[Deployment(name="api", image="bar", namespace="team-b")],
+    ).chart.apply()
+
+    stack = Stack(
+        name="my-stack",
+        deployments=[
+            Deployment(name="web", image="bar"),
+            Deployment(name="moved", image="bar", namespace="old"),
+        ],
+    )
+    stack.chart.apply()
+    stack.deployments.pop()
+    fake_kubernetes.requests.clear()
+
+    result = stack.chart.apply()
+    assert result.pruned == []
+    assert ("deployments", "team-b", "my-stack-api") in fake_kubernetes.objects
+    lists = {r[1] for r in fake_kubernetes.requests_for("GET") if r[1] != "/version"}
+    assert "/apis/apps/v1/deployments" not in lists
+    assert "/apis/apps/v1/namespaces/team-b/deployments" not in lists
+
+    result = stack.chart.apply(namespaces=["old"])
+    assert result.pruned == ["Deployment/old/my-stack-moved"]
+    assert ("deployments", "team-b", "my-stack-api") in fake_kubernetes.objects
+
+
+def release_of(stack):
+    return HelmRelease(
+        resource_definitions={
+            f"{m['kind']}/{m['metadata']['name']}": m
+            for m in yaml.safe_load_all(stack.to_yaml())
+        }
+    )
+
+
+def test_release_refresh(fake_kubernetes):
+    stack = make_stack(deployments=2)
+    deploy(fake_kubernetes, stack)
+    deploy(fake_kubernetes, make_stack(name="neighbour"))
+    release = release_of(stack)
+
+    release.refresh()
+    assert len(fake_kubernetes.requests_for("GET")) == 4
+    assert set(release.resources) == set(release.resource_definitions)
+
+    fake_kubernetes.set_status(
+        "deployments", "default", "my-stack-deploy-1", readyReplicas=1
+    )
+    fake_kubernetes.set_status(
+        "deployments", "default", "neighbour-deploy-1", readyReplicas=1
+    )
+    fake_kubernetes.delete("daemonsets", "default", "my-stack-a-daemonset")
+    release.refresh(timeout_seconds=0.2)
+
+    watches = [r for r in fake_kubernetes.requests if r[2].get("watch")]
+    assert len(watches) == 4
+    assert all(r[2]["resourceVersion"] for r in watches)
+    lists = [r for r in fake_kubernetes.requests_for("GET") if r[1] != "/version"]
+    assert {r[2]["labelSelector"] for r in lists if "/deployments" in r[1]} == {
+        "app.kubernetes.io/instance in (deploy-0,deploy-1)",
+        "app.kubernetes.io/instance in (other-ns)",
+    }
+    resources = release.resources
+    assert resources["Deployment/my-stack-deploy-1"].status.ready_replicas == 1
+    assert "DaemonSet/my-stack-a-daemonset" not in resources
+    assert "Deployment/neighbour-deploy-1" not in resources
+
+
+def test_release_background_watch(fake_kubernetes):
+    stack = make_stack(deployments=1)
+    deploy(fake_kubernetes, stack)
+    release = release_of(stack)
+
+    release.start(timeout_seconds=0.2)
+    try:
+        fake_kubernetes.set_status(
+            "statefulsets",
+            "default",
+            "my-stack-a-statefulset",
+            replicas=2,
+            readyReplicas=2,
+        )
+        for _ in range(50):
+            sts = release.resources["StatefulSet/my-stack-a-statefulset"]
+            if sts.status and sts.status.ready_replicas == 2:
+                break
+            time.sleep(0.05)
+        assert sts.status.ready_replicas == 2
+    finally:
+        release.stop()
+
+
+def converge(fake, stack):
+    """Report every resource of `stack` as rolled out"""
+    for key, obj in fake.objects.items():
+        plural, namespace, name = key
+        if not name.startswith(stack.name):
+            continue
+        generation = obj["metadata"]["generation"]
+        if plural == "daemonsets":
+            fake.set_status(
+                plural,
+                namespace,
+                name,
+                observedGeneration=generation,
+                currentNumberScheduled=1,
+                desiredNumberScheduled=1,
+                numberMisscheduled=0,
+                numberReady=1,
+                updatedNumberScheduled=1,
+                numberAvailable=1,
+            )
+        else:
+            replicas = obj["spec"].get("replicas", 1)
+            fake.set_status(
+                plural,
+                namespace,
+                name,
+                observedGeneration=generation,
+                replicas=replicas,
+                readyReplicas=replicas,
+                updatedReplicas=replicas,
+                availableReplicas=replicas,
+            )
+
+
+def test_wait_until_ready(fake_kubernetes):
+    stack = make_stack(deployments=2)
+    deploy(fake_kubernetes, stack)
+
+    timer = threading.Timer(0.1, converge, args=(fake_kubernetes, stack))
+    timer.start()
+    started = time.monotonic()
+    release = stack.chart.wait_until_ready(timeout=5, watch_timeout=0.5)
+    timer.join()
+
+    # Returns on the status events, stop() only waits for the pending watches
+    assert time.monotonic() - started < 1.5
+    assert set(release.resources) == set(release.resource_definitions)
+    watches = [r for r in fake_kubernetes.requests if r[2].get("watch")]
+    assert {r[1] for r in watches} == {
+        "/apis/apps/v1/namespaces/default/deployments",
+        "/apis/apps/v1/namespaces/other/deployments",
+        "/apis/apps/v1/namespaces/default/daemonsets",
+        "/apis/apps/v1/namespaces/default/statefulsets",
+    }
+
+
+def test_wait_until_ready_returns_on_convergence(fake_kubernetes):
+    stack = make_stack(deployments=1)
+    deploy(fake_kubernetes, stack)
+    converge(fake_kubernetes, stack)
+
+    started = time.monotonic()
+    release = stack.chart.wait_until_ready(timeout=5, watch_timeout=30)
+    # Not held by the watches still open on the fake server
+    assert time.monotonic() - started < 15
+    assert release._threads == []
+    assert release._stopped.is_set()
+
+
+def test_wait_until_ready_started_release(fake_kubernetes):
+    stack = make_stack(deployments=1)
+    deploy(fake_kubernetes, stack)
+    converge(fake_kubernetes, stack)
+    release = release_of(stack)
+
+    release.start(timeout_seconds=0.2)
+    try:
+        threads = list(release._threads)
+        assert release.wait_until_ready(timeout=5) is release
+        assert release._threads == threads
+        assert all(thread.is_alive() for thread in threads)
+
+        # The watches started by the caller keep following the changes
+        fake_kubernetes.set_status(
+            "deployments", "default", "my-stack-deploy-0", readyReplicas=0
+        )
+        for _ in range(50):
+            deploy_0 = release.resources["Deployment/my-stack-deploy-0"]
+            if deploy_0.status.ready_replicas == 0:
+                break
+            time.sleep(0.05)
+        assert deploy_0.status.ready_replicas == 0
+    finally:
+        release.stop()
+
+
+def test_wait_until_ready_stale_generation(fake_kubernetes):
+    stack = make_stack(deployments=1)
+    deploy(fake_kubernetes, stack)
+    converge(fake_kubernetes, stack)
+    # A new spec the controller did not observe yet
+    manifest = fake_kubernetes.objects["deployments", "default", "my-stack-deploy-0"]
+    manifest = dict(manifest, spec=dict(manifest["spec"], replicas=3))
+    fake_kubernetes.put("deployments", manifest)
+
+    with pytest.raises(TimeoutError, match="Deployment/my-stack-deploy-0"):
+        stack.chart.wait_until_ready(timeout=0.3, watch_timeout=0.2)
+
+
+def test_wait_until_ready_failure(fake_kubernetes):
+    stack = make_stack(deployments=1)
+    deploy(fake_kubernetes, stack)
+    fake_kubernetes.set_status(
+        "deployments",
+        "default",
+        "my-stack-deploy-0",
+        conditions=[
+            {
+                "type": "Progressing",
+                "status": "False",
+                "reason": "ProgressDeadlineExceeded",
+                "message": "deploy-0 has timed out progressing.",
+            }
+        ],
+    )
+
+    with pytest.raises(RolloutFailed, match="timed out progressing"):
+        stack.chart.wait_until_ready(timeout=5, watch_timeout=0.2)
@@ -0,0 +1,92 @@
+import sys
+import time
+from subprocess import CalledProcessError, TimeoutExpired
+
+import pytest
+import yaml
+
+from k8s_app_abstraction.models.stack import HelmRelease
+from k8s_app_abstraction.process import (
+    command_output,
+    run_command,
+    set_output_logger,
+    stream_output,
+)
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_stream_output_as_it_comes():
+    command = python(
+        "import sys, time\n"
+        "print('first', flush=True)\n"
+        "time.sleep(0.5)\n"
+        "print('second', file=sys.stderr)"
+    )
+    started = time.monotonic()
+    lines = stream_output(command)
+    assert next(lines) == "first"
+    assert time.monotonic() - started < 0.5
+    assert list(lines) == ["second"]
+
+
+def test_run_command_logger():
+    lines = []
+    run_command(python("print('a'); print('b')"), logger=lines.append)
+    assert lines == ["a", "b"]
+
+    set_output_logger(lines.append)
+    try:
+        run_command(python("print('c')"))
+    finally:
+        set_output_logger(None)
+    assert lines == ["a", "b", "c"]
+
+
+def test_run_command_failure():
+    lines = []
+    with pytest.raises(CalledProcessError) as e:
+        run_command(python("print('oops'); exit(3)"), logger=lines.append)
+    assert e.value.returncode == 3
+    assert lines == ["oops"]
+    assert e.value.output == "oops"
+
+
+def test_run_command_timeout():
+    started = time.monotonic()
+    with pytest.raises(TimeoutExpired):
+        run_command(python("import time; time.sleep(10)"), timeout=0.2)
+    assert time.monotonic() - started < 5
+
+
+def test_command_output_stderr_apart():
+    command = python("import sys; print('out'); print('err', file=sys.stderr)")
+    with command_output(command, merge_stderr=False) as output:
+        assert output.read() == "out\n"
+
+    command = python("import sys; print('- a'); print('err', file=sys.stderr); exit(1)")
+    with pytest.raises(CalledProcessError) as e:
+        with command_output(command, merge_stderr=False) as output:
+            yaml.safe_load(output.read() + ": {")
+    assert e.value.output == "err\n"
+
+
+def test_release_load(fake_helm):
+    fake_helm.install(
+        "my-stack",
+        "---\n# Source: my-stack/templates/a.yml\n"
+        "kind: Deployment\nmetadata:\n  name: my-stack-a\n"
+        "---\n# Source: my-stack/templates/b.yml\n"
+        "kind: DaemonSet\nmetadata:\n  name: my-stack-b\n",
+    )
+    release = HelmRelease.load("my-stack")
+    assert list(release.resource_definitions) == [
+        "Deployment/my-stack-a",
+        "DaemonSet/my-stack-b",
+    ]
+
+    with pytest.raises(CalledProcessError) as e:
+        HelmRelease.load("missing")
+    assert "not found" in e.value.output
@@ -0,0 +1,128 @@
+from io import StringIO
+
+import pytest
+
+from k8s_app_abstraction.instrumentation import add_listener, remove_listener
+from k8s_app_abstraction.models.base import _portable_context, render_pool
+from k8s_app_abstraction.models.pod_controllers import Deployment, Statefulset
+from k8s_app_abstraction.models.stack import Stack
+
+
+@pytest.fixture
+def rendered():
+    """Names of the resources rendered, in order"""
+    names = []
+
+    def listener(event, span):
+        if event == "end" and span.phase == "render":
+            names.append(span.name)
+
+    add_listener(listener)
+    yield names
+    remove_listener(listener)
+
+
+def make_stack(name="my-stack"):
+    return Stack(
+        name=name,
+        deployments=[
+            Deployment(name="web", image="bar"),
+            Deployment(name="worker", image="bar", command=["work"]),
+        ],
+        statefulsets=[Statefulset(name="db", image="postgres")],
+    )
+
+
+def test_to_yaml_memoized(rendered):
+    stack = make_stack()
+    content = stack.to_yaml()
+    assert len(rendered) == 3
+
+    assert stack.to_yaml() == content
+    assert len(rendered) == 3
+    # Memoized on the resources, other instances render their own
+    assert make_stack().to_yaml() == content
+    assert len(rendered) == 6
+
+
+def test_field_assignment_invalidates(rendered):
+    stack = make_stack()
+    fingerprint = stack.deployments[0].fingerprint
+    stack.to_yaml()
+
+    stack.deployments[0].image = "baz"
+    assert stack.deployments[0].fingerprint != fingerprint
+    del rendered[:]
+    content = stack.to_yaml()
+    # Only the assigned resource is rendered again
+    assert len(rendered) == 1
+    assert "image: baz" in content
+    assert content == make_stack().to_yaml().replace("image: bar", "image: baz", 1)
+
+
+def test_in_place_change_invalidates(rendered):
+    stack = make_stack()
+    stack.to_yaml()
+
+    stack.deployments[1].command.append("now")
+    content = stack.to_yaml()
+    assert len(rendered) == 4
+    assert "- now" in content
+    stream = StringIO()
+    stack.to_yaml(stream=stream)
+    assert stream.getvalue() == content
+
+
+def test_render_context():
+    stack = make_stack()
+    stack.to_yaml()
+    other = stack.to_yaml(context={"stack": make_stack(name="other")})
+    assert "name: other-web" in other
+    assert "name: my-stack-web" not in other
+    assert "name: my-stack-web" in stack.to_yaml()
+
+
+def test_parallel_render_memoized(rendered):
+    stack = make_stack()
+    context = {"stack": stack}
+    files = list(stack.yaml_files(context=context, processes=2))
+    assert all(res.rendered(context) for res in stack.get_all_resources)
+
+    assert list(stack.yaml_files(context=context)) == files
+    assert list(stack.yaml_files(context=context, processes=2)) == files
+    # Rendered on the worker processes only
+    assert rendered == []
+
+
+def test_render_pool_shared():
+    pool = render_pool(2)
+    for name in ("a", "b"):
+        stack = make_stack(name=name)
+        files = list(stack.chart.generate_files(processes=2))
+        assert files == list(make_stack(name=name).chart.generate_files())
+    assert render_pool(2) is pool
+    # The workers get the stack name, not the stack
+    context = _portable_context({"stack": stack})
+    assert context == {"stack": ("b",)}
+
+
+def test_dump_not_memoized(tmp_path):
+    stack = make_stack()
+    stack.chart.dump(str(tmp_path))
+    context = {"stack": stack}
+    assert not any(res.rendered(context) for res in stack.get_all_resources)
+
+    files = dict(stack.chart.generate_files())
+    assert all(res.rendered(context) for res in stack.get_all_resources)
+    for filename, content in files.items():
+        assert (tmp_path / filename).read_text() == content
+
+
+def test_chart_memoized():
+    stack = make_stack()
+    chart = stack.chart
+    assert stack.chart is chart
+
+    stack.description = "changed"
+    assert stack.chart is not chart
+    assert stack.chart.stack.description == "changed"
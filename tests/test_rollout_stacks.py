@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from k8s_app_abstraction.models.pod_controllers import Deployment
+from k8s_app_abstraction.models.stack import Stack, StackRollout, rollout_stacks
+
+
+def make_stacks(*names):
+    return [
+        Stack(name=name, deployments=[Deployment(name="web", image="bar")])
+        for name in names
+    ]
+
+
+def test_rollout_stacks(fake_kubernetes, fake_helm, monkeypatch):
+    monkeypatch.setenv("FAKE_HELM_SLEEP", "0.5")
+    stacks = make_stacks("db", "api", "front", "jobs")
+
+    started = time.monotonic()
+    results = rollout_stacks(
+        stacks, dependencies={"api": ["db"], "front": ["api"]}, concurrency=4
+    )
+    elapsed = time.monotonic() - started
+
+    assert [r.name for r in results] == ["db", "api", "front", "jobs"]
+    assert all(r.succeeded for r in results)
+    assert all(r.rollout_time >= 0.5 and r.render_time > 0 for r in results)
+    # db, api and front one after the other, jobs alongside
+    assert elapsed >= 1.5
+    upgrades = [call[2] for call in fake_helm.calls]
+    assert upgrades.index("db") < upgrades.index("api") < upgrades.index("front")
+    assert set(upgrades[:2]) == {"db", "jobs"}
+    # Dependencies finished first, the independent jobs ran alongside db
+    timings = {args[2]: (start, end) for args, start, end in fake_helm.timings}
+    assert timings["db"][1] <= timings["api"][0]
+    assert timings["api"][1] <= timings["front"][0]
+    assert timings["jobs"][0] < timings["db"][1]
+    assert timings["db"][0] < timings["jobs"][1]
+    assert "name: front-web" in fake_helm.manifests("front")
+    assert len(fake_kubernetes.requests_for("GET", "/version")) == 1
+
+
+def test_rollout_stacks_concurrency(fake_kubernetes, fake_helm, monkeypatch):
+    monkeypatch.setenv("FAKE_HELM_SLEEP", "0.3")
+    started = time.monotonic()
+    results = rollout_stacks(make_stacks("a", "b", "c", "d"), concurrency=2)
+    assert all(r.succeeded for r in results)
+    # Two at a time
+    assert time.monotonic() - started >= 0.6
+    assert sorted(call[2] for call in fake_helm.calls) == ["a", "b", "c", "d"]
+    assert fake_helm.max_concurrent_upgrades() == 2
+
+
+def test_rollout_stacks_failure(fake_kubernetes, fake_helm, monkeypatch):
+    monkeypatch.setenv("FAKE_HELM_FAIL", "db")
+    results = rollout_stacks(
+        make_stacks("db", "api", "front", "jobs"),
+        dependencies={"api": ["db"], "front": ["api"]},
+    )
+    status = {r.name: r.status for r in results}
+    assert status == {
+        "db": StackRollout.StatusEnum.failed,
+        "api": StackRollout.StatusEnum.skipped,
+        "front": StackRollout.StatusEnum.skipped,
+        "jobs": StackRollout.StatusEnum.succeeded,
+    }
+    assert "UPGRADE FAILED: db" in results[0].error
+    assert results[1].error == "Dependencies not rolled out: db"
+    assert {call[2] for call in fake_helm.calls} == {"db", "jobs"}
+
+
+def test_rollout_stacks_skip_unchanged(fake_kubernetes, fake_helm):
+    stacks = make_stacks("a", "b")
+    rollout_stacks(stacks)
+    stacks[1].deployments[0].replicas = 3
+
+    results = rollout_stacks(stacks, skip_unchanged=True)
+    assert [r.result.has_changes for r in results] == [False, True]
+    assert [call[:2] for call in fake_helm.calls[2:]] == [
+        ["get", "manifest"],
+        ["get", "manifest"],
+        ["upgrade", "--install"],
+    ]
+
+
+def test_rollout_stacks_processes(fake_kubernetes, fake_helm):
+    stacks = make_stacks("a", "b")
+    results = rollout_stacks(stacks, processes=2)
+    assert all(r.succeeded for r in results)
+    assert "name: b-web" in fake_helm.manifests("b")
+
+
+@pytest.mark.parametrize(
+    "dependencies, message",
+    [
+        ({"a": ["b"], "b": ["a"]}, "Dependency cycle between stacks: a, b"),
+        ({"a": ["z"]}, "Unknown dependencies of a: z"),
+    ],
+)
+def test_rollout_stacks_invalid_dependencies(fake_helm, dependencies, message):
+    with pytest.raises(ValueError, match=message):
+        rollout_stacks(make_stacks("a", "b"), dependencies=dependencies)
+    assert fake_helm.calls == []
@@ -1,10 +1,11 @@
 import os
-from subprocess import STDOUT
+import tarfile
+import tracemalloc
+from io import BytesIO, StringIO
+from subprocess import CalledProcessError
 from tempfile import TemporaryDirectory
-from unittest import mock
 from unittest.mock import call
 
-import kubernetes
 import pytest
 import yaml
 
@@ -13,7 +14,7 @@ from k8s_app_abstraction.models.pod_controllers import (
     Deployment,
     Statefulset,
 )
-from k8s_app_abstraction.models.stack import Stack
+from k8s_app_abstraction.models.stack import HelmRelease, Stack
 
 
 def test_basic():
@@ -71,6 +72,40 @@ def test_stack_to_yaml():
     assert daemonset["apiVersion"] == "apps/v1"
 
 
+def test_stack_to_yaml_stream():
+    stack = Stack(
+        name="my-stack",
+        deployments=[Deployment(name="a-deploy", image="bar", replicas=2)],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+        statefulsets=[Statefulset(name="a-statefulset", image="bar")],
+    )
+    stream = StringIO()
+
+    assert stack.to_yaml(stream=stream) is None
+    assert stream.getvalue() == stack.to_yaml()
+
+
+def test_stack_to_yaml_stream_memory_is_bounded():
+    class NullStream:
+        def write(self, data):
+            pass
+
+    def peak_memory(size):
+        stack = Stack(
+            name="my-stack",
+            deployments=[Deployment(name=f"d-{i}", image="bar") for i in range(size)],
+        )
+        tracemalloc.start()
+        try:
+            stack.to_yaml(stream=NullStream())
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    peak_memory(1)  # warm up caches
+    assert peak_memory(1000) < 2 * peak_memory(10)
+
+
 def test_stack_to_chart():
     stack = Stack(
         name="my-stack",
@@ -87,6 +122,19 @@ def test_stack_to_chart():
     ]
 
 
+def test_stack_to_chart_parallel():
+    stack = Stack(
+        name="my-stack",
+        deployments=[Deployment(name=f"deploy-{i}", image="bar") for i in range(20)],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+        statefulsets=[Statefulset(name=f"sts-{i}", image="bar") for i in range(5)],
+    )
+
+    serial = list(stack.chart.generate_files())
+    assert list(stack.chart.generate_files(processes=2)) == serial
+    assert list(stack.chart.generate_files(processes=3, chunksize=1)) == serial
+
+
 def test_stack_dump():
     stack = Stack(
         name="my-stack",
@@ -97,21 +145,62 @@ def test_stack_dump():
 
     with TemporaryDirectory() as location:
         stack.chart.dump(location)
-        assert set(os.listdir(location)) == {"templates", "Chart.yaml"}
+        assert set(os.listdir(location)) == {
+            "templates",
+            "Chart.yaml",
+            ".checksums.json",
+        }
         assert set(os.listdir(os.path.join(location, "templates"))) == {
             "deployment-a-deploy.yml",
             "daemonset-a-daemonset.yml",
             "statefulset-a-statefulset.yml",
         }
 
+        for filename, content in stack.chart.generate_files():
+            with open(os.path.join(location, filename)) as f:
+                assert f.read() == content
+
 
-@mock.patch("k8s_app_abstraction.models.stack.config")
-@mock.patch("k8s_app_abstraction.models.stack.client")
-def test_stack_install(mock_client, mock_config):
-    # Force compatibility with mocked kubernetes api and library version
-    kver = kubernetes.__version__.split(".")[0]
-    mock_client.VersionApi().get_code().git_version = f"v1.{kver}.0"
-    mock_client.VersionApi().get_code().minor = kver
+def test_stack_dump_incremental():
+    stack = Stack(
+        name="my-stack",
+        deployments=[Deployment(name="a-deploy", image="bar", replicas=2)],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+    )
+
+    with TemporaryDirectory() as location:
+        changes = stack.chart.dump(location)
+        assert changes.changed
+        assert changes.created == [
+            "Chart.yaml",
+            "templates/deployment-a-deploy.yml",
+            "templates/daemonset-a-daemonset.yml",
+        ]
+
+        changes = stack.chart.dump(location)
+        assert not changes.changed
+        assert len(changes.unchanged) == 3
+
+        # Hand-written templates are left alone
+        with open(os.path.join(location, "templates", "custom.yml"), "w") as f:
+            f.write("kind: ConfigMap\n")
+
+        stack.deployments[0].replicas = 3
+        stack.daemonsets.pop()
+        changes = stack.chart.dump(location)
+        assert changes.updated == ["templates/deployment-a-deploy.yml"]
+        assert changes.removed == ["templates/daemonset-a-daemonset.yml"]
+        assert changes.unchanged == ["Chart.yaml"]
+        assert set(os.listdir(os.path.join(location, "templates"))) == {
+            "custom.yml",
+            "deployment-a-deploy.yml",
+        }
+
+        changes = stack.chart.dump(location, force=True)
+        assert changes.updated == ["Chart.yaml", "templates/deployment-a-deploy.yml"]
+
+
+def test_stack_install(fake_kubernetes, fake_helm, capsys):
     stack = Stack(
         name="my-stack",
         deployments=[Deployment(name="a-deploy", image="bar", replicas=2)],
@@ -120,11 +209,136 @@ def test_stack_install(mock_client, mock_config):
     )
 
     with TemporaryDirectory() as location:
-        with mock.patch(
-            "k8s_app_abstraction.models.stack.check_output"
-        ) as check_output:
-            stack.chart.rollout(location)
+        stack.chart.rollout(location)
 
-        check_output.assert_called_once_with(
-            ["helm", "upgrade", "--install", "my-stack", location], stderr=STDOUT
-        )
+        assert fake_helm.calls == [["upgrade", "--install", "my-stack", location]]
+    assert "has been upgraded" in capsys.readouterr().out
+
+
+def test_stack_install_skip_unchanged(fake_kubernetes, fake_helm):
+    stack = Stack(
+        name="my-stack",
+        deployments=[Deployment(name="a-deploy", image="bar", replicas=2)],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+        statefulsets=[],
+    )
+    fake_helm.install(
+        "my-stack",
+        "".join(
+            f"---\n# Source: my-stack/templates/{filename}\n{content}"
+            for filename, content in stack.yaml_files(context={"stack": stack})
+        ),
+    )
+
+    diff = stack.chart.rollout(skip_unchanged=True)
+    assert not diff.has_changes
+    assert len(fake_helm.calls) == 1
+
+    stack.deployments[0].replicas = 3
+    stack.statefulsets.append(Statefulset(name="a-statefulset", image="bar"))
+    stack.daemonsets.pop()
+    diff = stack.chart.rollout(skip_unchanged=True)
+    assert diff.changed == {"Deployment/my-stack-a-deploy": ["spec.replicas"]}
+    assert diff.added == ["StatefulSet/my-stack-a-statefulset"]
+    assert diff.removed == ["DaemonSet/my-stack-a-daemonset"]
+    assert len(fake_helm.calls) == 3
+    assert fake_helm.calls[-1][:2] == ["upgrade", "--install"]
+    assert not stack.chart.diff().has_changes
+
+    # The server version is discovered once per session
+    assert len(fake_kubernetes.requests_for("GET", "/version")) == 1
+
+
+def test_stack_diff_helm_errors(fake_helm, monkeypatch):
+    stack = Stack(name="my-stack", deployments=[Deployment(name="web", image="bar")])
+    assert stack.chart.diff().added == ["Deployment/my-stack-web"]
+
+    def unreachable(name, timeout=None):
+        raise CalledProcessError(1, ["helm"], output="Error: cluster unreachable")
+
+    monkeypatch.setattr(HelmRelease, "load", unreachable)
+    with pytest.raises(CalledProcessError):
+        stack.chart.diff()
+
+    with pytest.raises(ValueError):
+        stack.chart.rollout(engine="apply", skip_unchanged=True)
+    assert fake_helm.calls == [["get", "manifest", "my-stack"]]
+
+
+def test_chart_archive():
+    stack = Stack(
+        name="my-stack",
+        deployments=[Deployment(name="a-deploy", image="bar", replicas=2)],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+    )
+    data = stack.chart.archive()
+    assert stack.chart.archive() == data
+
+    with tarfile.open(fileobj=BytesIO(data)) as tar:
+        files = {m.name: tar.extractfile(m).read().decode() for m in tar}
+    assert files == {
+        f"my-stack/{filename}": content
+        for filename, content in stack.chart.generate_files()
+    }
+
+    with TemporaryDirectory() as location:
+        path = stack.chart.package(location)
+        mtime = os.stat(path).st_mtime_ns
+        assert stack.chart.package(location) == path
+        assert os.stat(path).st_mtime_ns == mtime
+
+        stack.deployments[0].replicas = 3
+        assert stack.chart.package(location) != path
+        assert len(os.listdir(location)) == 2
+
+
+def test_stack_install_archive(fake_kubernetes, fake_helm, monkeypatch):
+    stack = Stack(
+        name="my-stack",
+        deployments=[Deployment(name="a-deploy", image="bar", replicas=2)],
+    )
+
+    stack.chart.rollout()
+    archive = fake_helm.calls[-1][-1]
+    assert archive.endswith(".tgz")
+    assert not os.path.exists(archive)
+    assert not stack.chart.diff().has_changes
+
+    with TemporaryDirectory() as location:
+        stack.chart.rollout(location, package=True)
+        assert fake_helm.calls[-1][-1] == stack.chart.package(location)
+        assert os.listdir(location) == [os.path.basename(fake_helm.calls[-1][-1])]
+
+    # Removed as well when helm fails
+    monkeypatch.setenv("FAKE_HELM_FAIL", "my-stack")
+    with pytest.raises(CalledProcessError):
+        stack.chart.rollout()
+    assert not os.path.exists(fake_helm.calls[-1][-1])
+
+
+def test_stack_trusted_construction():
+    definition = {
+        "description": "generated",
+        "deployments": {
+            f"deploy-{i}": {"image": f"app:{i}", "replicas": i % 3 + 1}
+            for i in range(200)
+        },
+        "daemonsets": {"agent": {"image": "agent", "command": ["run"]}},
+        "statefulsets": {"db": {"image": "postgres", "unknown": "ignored"}},
+    }
+    content = yaml.safe_dump(definition)
+    validated = Stack.new("my-stack", content)
+    trusted = Stack.new("my-stack", content, trusted=True)
+
+    assert trusted.dict() == validated.dict()
+    assert trusted.to_yaml() == validated.to_yaml()
+    for field in ("deployments", "daemonsets", "statefulsets"):
+        assert type(getattr(trusted, field)) is type(getattr(validated, field))
+    assert [r.fingerprint for r in trusted.get_all_resources] == [
+        r.fingerprint for r in validated.get_all_resources
+    ]
+    assert trusted.statefulsets[0].namespace == "default"
+    assert not hasattr(trusted.statefulsets[0], "unknown")
+
+    trusted.deployments[0].replicas = 5
+    assert "replicas: 5" in trusted.to_yaml()
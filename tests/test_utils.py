@@ -1,8 +1,21 @@
 from textwrap import dedent
 
 import pytest
+import yaml
+from jinja2 import Environment
 
-from k8s_app_abstraction.utils import camelize, merge, parse_yaml
+from k8s_app_abstraction.utils import (
+    LazyString,
+    LRUCache,
+    Prefixed,
+    TemplateCache,
+    camelize,
+    camelized_keys,
+    dict_to_yaml,
+    merge,
+    parse_yaml,
+    template_cache,
+)
 
 
 def test_merge_dict():
@@ -12,6 +25,24 @@ def test_merge_dict():
     assert dict(merge(a, b)) == {"foo": "bar", "baz": "spam"}
 
 
+def test_merge_many_dicts():
+    a = {"foo": {"a": 1, "b": 1}, "bar": 1, "untouched": {"x": 1}}
+    b = {"foo": {"b": 2, "c": 2}, "bar": {"a": 2}}
+    c = {"spam": 3, "foo": {"c": 3}, "bar": {"b": 3}}
+
+    merged = merge(a, b, c)
+    assert merged == {
+        "foo": {"a": 1, "b": 2, "c": 3},
+        "bar": {"a": 2, "b": 3},
+        "untouched": {"x": 1},
+        "spam": 3,
+    }
+    assert list(merged) == ["foo", "bar", "untouched", "spam"]
+    assert list(merged["foo"]) == ["a", "b", "c"]
+    assert merged["untouched"] is a["untouched"]
+    assert merge(a, b, c) == dict(merge(merge(a, b), c))
+
+
 def test_merge_yaml():
     content = dedent(
         """
@@ -59,3 +90,75 @@ def test_nested_merge_yaml():
 )
 def test_camelize(original, expected):
     assert camelize(original) == expected
+
+
+def test_camelized_keys_from_kubernetes_models():
+    table = camelized_keys()
+    assert table["api_version"] == "apiVersion"
+    assert table["match_labels"] == "matchLabels"
+    # Already camelized keys are left as is
+    assert table["matchLabels"] == "matchLabels"
+    assert camelize("hostIP") == "hostIP"
+
+
+def test_dict_to_yaml_formatting():
+    data = {
+        "api_version": "v1",
+        "spec": {
+            "Pod_Spec": [{"image_pull_policy": "Always", "args": None}, [1, None]],
+            "empty": {},
+        },
+        "status": None,
+    }
+
+    assert yaml.safe_load(dict_to_yaml(data)) == {
+        "apiVersion": "v1",
+        "spec": {"podSpec": [{"imagePullPolicy": "Always"}, [1, None]], "empty": {}},
+    }
+
+
+class FakeStack:
+    name = "my-stack"
+
+
+def test_lazy_string_render_is_cached():
+    template_cache.clear()
+    lazy = LazyString("{{ prefix('foo') }}-{{ resolve('bar') }}")
+
+    assert lazy.render({"stack": FakeStack()}) == "my-stack-foo-bar"
+    assert lazy.render({"stack": FakeStack()}) == "my-stack-foo-bar"
+
+    info = template_cache.info()
+    assert info.misses == 1
+    assert info.hits == 1
+    assert info.currsize == 1
+
+
+def test_prefixed_fast_path():
+    template_cache.clear()
+    assert Prefixed("foo").render({"stack": FakeStack()}) == "my-stack-foo"
+    assert template_cache.info().misses == 0
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    for key in "abc":
+        assert cache.get(key, lambda: key.upper()) == key.upper()
+    assert cache.lookup("a") is None
+    assert cache.get("c", lambda: "other") == "C"
+    assert cache.info() == (1, 4, 2, 2)
+
+    cache.clear()
+    assert cache.info() == (0, 0, 2, 0)
+
+
+def test_template_cache_is_bounded():
+    cache = TemplateCache(Environment(), maxsize=2)
+    first = cache.get("{{ 1 }}")
+    cache.get("{{ 2 }}")
+    cache.get("{{ 1 }}")
+    cache.get("{{ 3 }}")
+
+    assert cache.info().currsize == 2
+    assert cache.get("{{ 1 }}") is first
+    assert cache.info().misses == 3
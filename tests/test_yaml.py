@@ -1,11 +1,19 @@
+import time
 from io import StringIO
 from textwrap import dedent
 from unittest import mock
 
 import pytest
 import requests
+import yaml
 
+from k8s_app_abstraction.models.pod_controllers import (
+    Daemonset,
+    Deployment,
+    Statefulset,
+)
 from k8s_app_abstraction.models.stack import Stack
+from k8s_app_abstraction.utils import IncludeCycleError, dict_to_yaml, parse_yaml
 
 DEFINITION = """
 include:
@@ -82,7 +90,8 @@ def test_include():
 
     with mock.patch("k8s_app_abstraction.utils.open", new=mock_open):
         with mock.patch(
-            "k8s_app_abstraction.utils.requests.get", new=mock_requests_get
+            "k8s_app_abstraction.utils.requests.Session.get",
+            new=lambda self, url, *args, **kwargs: mock_requests_get(url),
         ):
             stack = Stack.new(name="test", definition=DEFINITION)
             resources = {
@@ -102,3 +111,105 @@ def test_include():
 
             # From URL
             assert "Deployment/other-app" in resources
+
+
+def test_include_merge_order_is_preserved():
+    files = {
+        "slow.yml": "deployments:\n  app:\n    image: slow\n    replicas: 2\n",
+        "fast.yml": "deployments:\n  app:\n    image: fast\n",
+    }
+
+    def mock_open(name, *args, **kwargs):
+        if name == "slow.yml":
+            time.sleep(0.1)
+        return StringIO(files[name])
+
+    definition = "include:\n- slow.yml\n- fast.yml\n"
+    with mock.patch("k8s_app_abstraction.utils.open", new=mock_open):
+        stack = Stack.new(name="test", definition=definition)
+
+    assert stack.deployments[0].image == "fast"
+    assert stack.deployments[0].replicas == 2
+
+
+def test_include_merged_under_its_document():
+    files = {"inc.yml": "x: scalar\n"}
+
+    def mock_open(name, *args, **kwargs):
+        return StringIO(files[name])
+
+    definition = "x:\n  a: 1\n---\ninclude:\n- inc.yml\nx:\n  b: 2\n"
+    with mock.patch("k8s_app_abstraction.utils.open", new=mock_open):
+        assert parse_yaml(definition) == {"x": {"a": 1, "b": 2}}
+
+
+def test_include_diamond_loads_shared_file_once():
+    files = {
+        "base.yml": "deployments:\n  base:\n    image: base\n",
+        "left.yml": "include:\n- base.yml\ndeployments:\n  left:\n    image: l\n",
+        "right.yml": "include:\n- base.yml\ndeployments:\n  right:\n    image: r\n",
+    }
+    opened = []
+
+    def mock_open(name, *args, **kwargs):
+        opened.append(name)
+        return StringIO(files[name])
+
+    definition = "include:\n- left.yml\n- right.yml\n- base.yml\n"
+    with mock.patch("k8s_app_abstraction.utils.open", new=mock_open):
+        stack = Stack.new(name="test", definition=definition)
+
+    assert sorted(opened) == ["base.yml", "left.yml", "right.yml"]
+    assert {d.name for d in stack.deployments} == {"base", "left", "right"}
+
+
+def test_include_cycle():
+    files = {
+        "a.yml": "include:\n- b.yml\n",
+        "b.yml": "include:\n- c.yml\n",
+        "c.yml": "include:\n- a.yml\n",
+    }
+
+    def mock_open(name, *args, **kwargs):
+        return StringIO(files[name])
+
+    with mock.patch("k8s_app_abstraction.utils.open", new=mock_open):
+        with pytest.raises(IncludeCycleError) as err:
+            Stack.new(name="test", definition="include:\n- a.yml\n")
+
+    assert str(err.value) == "Include cycle detected: a.yml -> b.yml -> c.yml -> a.yml"
+
+
+@pytest.mark.skipif(not yaml.__with_libyaml__, reason="PyYAML built without libyaml")
+def test_libyaml_dumper_output_is_identical():
+    stack = Stack(
+        name="my-stack",
+        description="Multi\nline description with ñ and a " + "long " * 30,
+        deployments=[
+            Deployment(
+                name="a-deploy",
+                image="bar",
+                replicas=2,
+                command=["sh", "-c", "echo 'yes' && sleep 10"],
+            )
+        ],
+        daemonsets=[Daemonset(name="a-daemonset", image="bar")],
+        statefulsets=[Statefulset(name="a-statefulset", image="bar")],
+    )
+    context = {"stack": stack}
+
+    for manifest in stack.generate():
+        assert dict_to_yaml(
+            manifest, context=context, camelize_keys=False
+        ) == dict_to_yaml(
+            manifest, context=context, camelize_keys=False, dumper=yaml.SafeDumper
+        )
+        # Camelizing the keys of generated manifests leaves them unchanged
+        assert dict_to_yaml(manifest, context=context) == dict_to_yaml(
+            manifest, context=context, camelize_keys=False
+        )
+
+    # libyaml folds long double-quoted scalars differently, these must fall
+    # back to the pure python emitter
+    info = {"description": stack.description}
+    assert dict_to_yaml(info) == yaml.safe_dump(info)